@@ -1,17 +1,46 @@
 #!/usr/bin/python3
 
 from zoneinfo import ZoneInfo
+import bz2
+import io
+import lzma
+import os
+import queue
 import signal
-from typing import List, Optional, Any, Callable
+import stat
+import threading
+import time
+import zipfile
+import zlib
+from array import array
+from typing import (
+    List,
+    Optional,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    Sequence,
+    Tuple,
+)
 import re
 import sys
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 from re import Pattern
+import json
+import math
+import operator
 from json import dumps
 from datetime import datetime, date
 from ipaddress import ip_address, IPv4Address, IPv6Address
-from datetime import timezone
+from datetime import timezone, timedelta
 from argparse import ArgumentParser, RawDescriptionHelpFormatter, BooleanOptionalAction
 
+import linestats
+from linestats import Stats, map_ordered, split_chunks, timer
+
 
 def json_mapper(obj):
     if isinstance(obj, (datetime, date)):
@@ -30,6 +59,33 @@ def parse_int(value: str) -> Optional[int]:
     return int(value)
 
 
+def parse_float(value: str) -> Optional[float]:
+    if value == "-":
+        return None
+    return float(value)
+
+
+def parse_ip(value: str) -> Optional[IPv4Address | IPv6Address]:
+    if value == "-":
+        return None
+    return ip_address(value)
+
+
+# Upstream variables may contain several values,
+# separated by commas (several servers) or colons (internal redirections).
+UPSTREAM_SEPARATOR = re.compile(", | : ")
+
+
+def make_list_converter(converter: Callable[[str], Any]) -> Callable[[str], Any]:
+    def convert(value: str) -> Any:
+        values = [converter(item) for item in UPSTREAM_SEPARATOR.split(value)]
+        if len(values) == 1:
+            return values[0]
+        return values
+
+    return convert
+
+
 def load_tz(tzname: str):
     if tzname == "UTC":
         return timezone.utc
@@ -37,56 +93,367 @@ def load_tz(tzname: str):
         return ZoneInfo(tzname)
 
 
+MONTHS = {
+    month: i + 1
+    for i, month in enumerate(
+        ["Jan", "Feb", "Mar", "Apr", "May", "Jun"]
+        + ["Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+    )
+}
+
+_offset_timezones: dict = {}
+
+
+def _offset_timezone(sign: str, hours: int, minutes: int) -> timezone:
+    key = (sign, hours, minutes)
+    res = _offset_timezones.get(key)
+    if res is None:
+        offset = timedelta(hours=hours, minutes=minutes)
+        res = timezone(-offset if sign == "-" else offset)
+        _offset_timezones[key] = res
+    return res
+
+
+def _parse_clf_date(value: str) -> Optional[datetime]:
+    """Fast path for the fixed-width "10/Oct/2000:13:55:36 -0700" layout."""
+    if (
+        len(value) != 26
+        or not value.isascii()
+        or value[2] != "/"
+        or value[6] != "/"
+        or value[11] != ":"
+        or value[14] != ":"
+        or value[17] != ":"
+        or value[20] != " "
+        or value[21] not in "+-"
+    ):
+        return None
+    month = MONTHS.get(value[3:6])
+    digits = (
+        value[0:2]
+        + value[7:11]
+        + value[12:14]
+        + value[15:17]
+        + value[18:20]
+        + value[22:26]
+    )
+    if month is None or not digits.isdigit():
+        return None
+    return datetime(
+        int(value[7:11]),
+        month,
+        int(value[0:2]),
+        int(value[12:14]),
+        int(value[15:17]),
+        int(value[18:20]),
+        tzinfo=_offset_timezone(value[21], int(value[22:24]), int(value[24:26])),
+    )
+
+
 def parse_date(value: str, tz) -> datetime:
-    return datetime.strptime(value, "%d/%b/%Y:%H:%M:%S %z").astimezone(tz)
+    res = _parse_clf_date(value)
+    if res is None:
+        res = datetime.strptime(value, "%d/%b/%Y:%H:%M:%S %z")
+    return res.astimezone(tz)
+
+
+def make_date_parser(tz) -> Callable[[str], datetime]:
+    """Build a date parser for a given timezone.
+
+    Consecutive log entries usually share the same timestamp: timestamp
+    fields are `cached` fields (see Field), so the parser itself does not
+    cache its results.
+    """
+
+    def parse(value: str) -> datetime:
+        return parse_date(value, tz)
+
+    return parse
 
 
 class Field:
+    """A field of a log format
+
+    The values of `cached` fields are expected to repeat often (client
+    addresses, user agents, etc.): the decoded and converted values are kept
+    in a LRU cache keyed on the raw bytes. This avoids converting the same
+    values again and again and shares the resulting objects (strings are
+    effectively interned).
+
+    `kind` is the type of the converted values (see make_converter).
+    """
+
     name: str
     regex: str
     converter: Callable[[str], Any] | None
+    cached: bool
+    kind: Optional[str]
 
     def __init__(
-        self, name: str, regex: str, converter: Callable[[str], Any] | None = None
+        self,
+        name: str,
+        regex: str,
+        converter: Callable[[str], Any] | None = None,
+        cached: bool = False,
+        kind: Optional[str] = None,
     ) -> None:
         self.name = name
         self.regex = regex
         self.converter = converter
+        self.cached = cached
+        self.kind = kind
+
+
+class Literal:
+    """Literal text (as opposed to a regex snippet given as a plain str)"""
+
+    value: str
+
+    def __init__(self, value: str) -> None:
+        self.value = value
+
+
+# Regex of a field which can be split without using a regex,
+# ie. "[^...]+", "[^...]*", ".+" or ".*".
+_SPLITTABLE_REGEX = re.compile(r"(?:\[\^(\]?(?:\\.|[^]\\-])*)\]|\.)([*+])")
+
+
+def _splittable_chars(regex: str) -> Optional[str]:
+    """Characters excluded by a field regex or None if the regex is not splittable"""
+    match = _SPLITTABLE_REGEX.fullmatch(regex)
+    if match is None:
+        return None
+    return re.sub(r"\\(.)", r"\1", match.group(1) or "")
+
+
+# Lines are processed as bytes and only the captured values are decoded.
+# Malformed UTF-8 is escaped (eg. "\\xff") instead of raising an error.
+ENCODING = "utf-8"
+DECODE_ERRORS = "backslashreplace"
+
+
+def decode(value: bytes) -> str:
+    return value.decode(ENCODING, DECODE_ERRORS)
+
+
+CACHE_SIZE = 4096
 
 
 class Format:
-    _tokens: List[Field | str]
+    _tokens: List[Field | Literal | str]
     _fields: List[Field]
     _pattern = Pattern
+    _prefix: bytes
+    _layout: Optional[List[Tuple[bytes, bool, Optional[bytes]]]]
+    _converters: dict
 
-    def __init__(self, tokens: List[Field | str]) -> None:
+    def __init__(self, tokens: List[Field | Literal | str]) -> None:
         self._tokens = tokens
 
         regex_string = (
             "^"
             + "".join(
-                # TODO, difference between "literal" and "regex snippet"
-                ("(" + token.regex + ")") if isinstance(token, Field) else token
+                (
+                    ("(" + token.regex + ")")
+                    if isinstance(token, Field)
+                    else re.escape(token.value) if isinstance(token, Literal) else token
+                )
                 for token in tokens
             )
             + "$"
         )
-        self._pattern = re.compile(regex_string)
+        self._pattern = re.compile(regex_string.encode(ENCODING))
 
         self._fields = [token for token in tokens if isinstance(token, Field)]
+        self._layout = self._make_layout()
+        self._converters = {}
+
+    def _make_layout(self) -> Optional[List[Tuple[bytes, bool, Optional[bytes]]]]:
+        """Describe how to split the line using only the literal delimiters.
+
+        This is only possible if all the fields are separated by literals and
+        the first character of each delimiter cannot appear in the preceding
+        field. In this case, the delimiter is the first occurrence of this
+        character and this is equivalent to using the regex. Only ASCII
+        characters are considered in order to work on the encoded line.
+
+        Each item is (excluded_chars, allow_empty, delimiter).
+        """
+        tokens = list(self._tokens)
+        self._prefix = b""
+        if tokens and isinstance(tokens[0], Literal):
+            self._prefix = tokens.pop(0).value.encode(ENCODING)
+        layout = []
+        while tokens:
+            field = tokens.pop(0)
+            if not isinstance(field, Field):
+                return None
+            excluded = _splittable_chars(field.regex)
+            if excluded is None or not excluded.isascii():
+                return None
+            allow_empty = field.regex.endswith("*")
+            if not tokens:
+                layout.append((excluded.encode(), allow_empty, None))
+                break
+            delimiter = tokens.pop(0)
+            if not isinstance(delimiter, Literal) or delimiter.value == "":
+                return None
+            delimiter = delimiter.value
+            if delimiter[0] not in excluded:
+                return None
+            excluded = excluded.replace(delimiter[0], "")
+            layout.append((excluded.encode(), allow_empty, delimiter.encode(ENCODING)))
+        return layout
 
-    def parse(self, data: str) -> Optional[dict]:
+    def _split(self, data: bytes) -> Optional[List[bytes]]:
+        if not data.startswith(self._prefix):
+            return None
+        pos = len(self._prefix)
+        groups = []
+        for excluded, allow_empty, delimiter in self._layout:
+            if delimiter is None:
+                end = len(data)
+                next_pos = end
+            else:
+                end = data.find(delimiter[:1], pos)
+                if end == -1 or not data.startswith(delimiter, end):
+                    return None
+                next_pos = end + len(delimiter)
+            value = data[pos:end]
+            if not allow_empty and value == b"":
+                return None
+            for char in excluded:
+                if char in value:
+                    return None
+            groups.append(value)
+            pos = next_pos
+        if pos != len(data):
+            return None
+        return groups
+
+    @property
+    def field_names(self) -> List[str]:
+        return [field.name for field in self._fields]
+
+    def get_field(self, name: str) -> Field:
+        for field in self._fields:
+            if field.name == name:
+                return field
+        raise ValueError("Unknown field " + name)
+
+    def _groups(self, data: bytes) -> Optional[Sequence[bytes]]:
+        if self._layout is not None:
+            return self._split(data)
         match = self._pattern.match(data)
         if match is None:
             return None
-        groups = match.groups()
+        return match.groups()
+
+    def _converter(self, field: Field, cache_size: int) -> Callable[[bytes], Any]:
+        """Function decoding and converting the raw value of a field"""
+        res = self._converters.get(field.name)
+        if res is not None:
+            return res
+        converter = field.converter
+        if converter is None:
+            res = decode
+        else:
+            res = lambda value: converter(decode(value))
+        if field.cached and cache_size > 0:
+            res = lru_cache(maxsize=cache_size)(res)
+        self._converters[field.name] = res
+        return res
+
+    def cache_info(self) -> dict:
         return {
-            field.name: (
-                field.converter(groups[i]) if field.converter is not None else groups[i]
-            )
-            for i, field in enumerate(self._fields)
+            name: converter.cache_info()
+            for name, converter in self._converters.items()
+            if hasattr(converter, "cache_info")
         }
 
+    def parser(
+        self,
+        fields: Optional[List[str]] = None,
+        conditions: Sequence[Tuple[str, Callable[[bytes], bool]]] = (),
+        cache_size: int = CACHE_SIZE,
+        stats: Optional[Stats] = None,
+        debug: bool = False,
+    ) -> Callable[[bytes], Optional[dict]]:
+        """Build a parser returning only some fields of the matching lines
+
+        The conditions are (field name, test) pairs. They are evaluated on the
+        raw (undecoded) values before any conversion. Only the selected fields
+        are decoded and converted.
+
+        With `stats`, the time spent matching ("parse") and converting
+        ("convert") is measured and rejected lines are counted by reason.
+
+        With `debug`, the lines which cannot be parsed (no match or invalid
+        value) are written to stderr. Filtered lines are not.
+        """
+        indices = {field.name: i for i, field in enumerate(self._fields)}
+        for name in (fields or []) + [name for name, test in conditions]:
+            if name not in indices:
+                raise ValueError("Unknown field " + name)
+        if fields is None:
+            fields = [field.name for field in self._fields]
+        selected = [
+            (
+                name,
+                indices[name],
+                self._converter(self._fields[indices[name]], cache_size),
+            )
+            for name in fields
+        ]
+        tests = [(indices[name], test) for name, test in conditions]
+        get_groups = self._groups
+
+        def unparsed(data: bytes) -> None:
+            if debug:
+                sys.stderr.buffer.write(data + b"\n")
+            return None
+
+        def parse(data: bytes) -> Optional[dict]:
+            groups = get_groups(data)
+            if groups is None:
+                return unparsed(data)
+            for i, test in tests:
+                if not test(groups[i]):
+                    return None
+            try:
+                return {name: convert(groups[i]) for name, i, convert in selected}
+            except ValueError:
+                return unparsed(data)
+
+        if stats is None:
+            return parse
+        times = stats.times
+
+        def parse_with_stats(data: bytes) -> Optional[dict]:
+            start = timer()
+            groups = get_groups(data)
+            matched = timer()
+            times["parse"] += matched - start
+            if groups is None:
+                stats.reject("no_match")
+                return unparsed(data)
+            try:
+                for i, test in tests:
+                    if not test(groups[i]):
+                        stats.reject("filtered")
+                        return None
+                try:
+                    res = {name: convert(groups[i]) for name, i, convert in selected}
+                except ValueError:
+                    stats.reject("invalid_value")
+                    return unparsed(data)
+            finally:
+                times["convert"] += timer() - matched
+            stats.lines_matched += 1
+            return res
+
+        return parse_with_stats
+
 
 # NGINX defult combined format:
 # log_format combined '$remote_addr - $remote_user [$time_local] '
@@ -98,32 +465,1376 @@ class Format:
 
 
 def make_combined_format_parser(tz):
+    parse_timestamp = make_date_parser(tz)
     return Format(
         [
-            Field("remote_addr", "[^ ]+", converter=ip_address),
+            Field("remote_addr", "[^ ]+", converter=ip_address, cached=True, kind="ip"),
             " [^ ]+ ",
-            Field("remote_user", "[^ ]+"),
+            Field("remote_user", "[^ ]+", cached=True),
             " \\[",
-            Field("timestamp", "[^]]+", converter=lambda x: parse_date(x, tz)),
+            Field(
+                "timestamp",
+                "[^]]+",
+                converter=parse_timestamp,
+                cached=True,
+                kind="time_local",
+            ),
             '\\] "',
-            Field("method", "[^ ]+"),
+            Field("method", "[^ ]+", cached=True),
             " ",
-            Field("path", '[^ "]+'),
+            Field("path", '[^ "]+', cached=True),
             " ",
-            Field("protocol", '[^ "]+'),
+            Field("protocol", '[^ "]+', cached=True),
             '" ',
-            Field("status", "[-0-9]+", converter=parse_int),
+            Field("status", "[-0-9]+", converter=parse_int, cached=True, kind="int"),
             " ",
-            Field("body_bytes_sent", "[-0-9]+", converter=parse_int),
+            Field("body_bytes_sent", "[-0-9]+", converter=parse_int, kind="int"),
             ' "',
-            Field("http_referer", '[^"]+'),
+            Field("http_referer", '[^"]+', cached=True),
             '" "',
-            Field("http_user_agent", '[^"]+'),
+            Field("http_user_agent", '[^"]+', cached=True),
             '"',
         ]
     )
 
 
+# Compilation of nginx log_format and Apache LogFormat strings:
+
+LOG_FORMATS = {
+    "combined": (
+        "nginx",
+        '$remote_addr - $remote_user [$time_local] "$request" $status '
+        + '$body_bytes_sent "$http_referer" "$http_user_agent"',
+    ),
+    "common": ("apache", '%h %l %u %t "%r" %>s %b'),
+}
+
+NGINX_VARIABLE_TYPES = {
+    "remote_addr": "ip",
+    "realip_remote_addr": "ip",
+    "server_addr": "ip",
+    "remote_port": "int",
+    "realip_remote_port": "int",
+    "server_port": "int",
+    "status": "int",
+    "body_bytes_sent": "int",
+    "bytes_sent": "int",
+    "request_length": "int",
+    "content_length": "int",
+    "connection": "int",
+    "connection_requests": "int",
+    "pid": "int",
+    "request_time": "float",
+    "gzip_ratio": "float",
+    "upstream_status": "int_list",
+    "upstream_bytes_received": "int_list",
+    "upstream_bytes_sent": "int_list",
+    "upstream_response_length": "int_list",
+    "upstream_response_time": "float_list",
+    "upstream_connect_time": "float_list",
+    "upstream_header_time": "float_list",
+    "time_local": "time_local",
+    "time_iso8601": "time_iso8601",
+    "msec": "epoch",
+}
+
+# Apache directive -> (field name, type)
+APACHE_DIRECTIVES = {
+    "a": ("remote_addr", "ip"),
+    "A": ("server_addr", "ip"),
+    "B": ("body_bytes_sent", "int"),
+    "b": ("body_bytes_sent", "int"),
+    "D": ("request_time_us", "int"),
+    "f": ("filename", None),
+    "h": ("remote_host", None),
+    "H": ("server_protocol", None),
+    "I": ("bytes_received", "int"),
+    "k": ("keepalive_requests", "int"),
+    "l": ("remote_logname", None),
+    "L": ("log_id", None),
+    "m": ("request_method", None),
+    "O": ("bytes_sent", "int"),
+    "p": ("server_port", "int"),
+    "P": ("pid", "int"),
+    "q": ("query_string", None),
+    "r": ("request", None),
+    "R": ("handler", None),
+    "s": ("status", "int"),
+    "S": ("bytes_transferred", "int"),
+    "t": ("time_local", "time_local"),
+    "T": ("request_time_s", "int"),
+    "u": ("remote_user", None),
+    "U": ("uri", None),
+    "v": ("server_name", None),
+    "V": ("server_name_used", None),
+    "X": ("connection_status", None),
+}
+
+# Apache %{...}X directive -> (field name prefix, type)
+APACHE_PARAMETRIZED_DIRECTIVES = {
+    "i": ("http_", None),
+    "o": ("sent_http_", None),
+    "C": ("cookie_", None),
+    "e": ("env_", None),
+    "n": ("note_", None),
+    "^ti": ("trailer_", None),
+    "^to": ("sent_trailer_", None),
+}
+
+APACHE_EPOCH_TYPES = {"sec": "epoch", "msec": "epoch_ms", "usec": "epoch_us"}
+
+NGINX_VARIABLE = re.compile(r"\$(?:\{(\w+)\}|(\w+))")
+APACHE_DIRECTIVE = re.compile(
+    r"%(?:!?[0-9]+(?:,[0-9]+)*)?[<>]?(?:\{([^}]*)\})?(\^t[io]|[a-zA-Z%])"
+)
+APACHE_ESCAPE = re.compile(r"\\(.)")
+APACHE_ESCAPES = {"n": "\n", "t": "\t"}
+
+
+def make_converter(kind: Optional[str], tz) -> Callable[[str], Any] | None:
+    if kind is None:
+        return None
+    elif kind == "int":
+        return parse_int
+    elif kind == "float":
+        return parse_float
+    elif kind == "int_list":
+        return make_list_converter(parse_int)
+    elif kind == "float_list":
+        return make_list_converter(parse_float)
+    elif kind == "ip":
+        return parse_ip
+    elif kind == "time_local":
+        return make_date_parser(tz)
+    elif kind == "time_iso8601":
+        return lambda value: datetime.fromisoformat(value).astimezone(tz)
+    elif kind == "epoch":
+        return lambda value: datetime.fromtimestamp(float(value), tz)
+    elif kind == "epoch_ms":
+        return lambda value: datetime.fromtimestamp(int(value) / 1000, tz)
+    elif kind == "epoch_us":
+        return lambda value: datetime.fromtimestamp(int(value) / 1000000, tz)
+    raise ValueError("Unexpected field type " + kind)
+
+
+# Types of values which are likely to repeat:
+CACHED_TYPES = {None, "ip", "time_local", "time_iso8601"}
+
+
+def make_format(items: List[Tuple[str, Optional[str]] | str], tz) -> Format:
+    """Build a Format from a list of literal strings and (name, type) fields
+
+    Each field matches everything up to the first character of the literal
+    which follows it which makes it possible to split the line without
+    using the regex. Adjacent fields (eg. "$status$body_bytes_sent") cannot
+    be separated and are rejected.
+    """
+    # Merge adjacent literals:
+    merged: List[Tuple[str, Optional[str]] | str] = []
+    for item in items:
+        if isinstance(item, str) and merged and isinstance(merged[-1], str):
+            merged[-1] += item
+        elif item != "":
+            merged.append(item)
+
+    tokens: List[Field | Literal | str] = []
+    for i, item in enumerate(merged):
+        if isinstance(item, str):
+            tokens.append(Literal(item))
+            continue
+        name, kind = item
+        if i + 1 == len(merged):
+            regex = ".*"
+        elif isinstance(merged[i + 1], str):
+            regex = "[^" + re.escape(merged[i + 1][0]) + "]*"
+        else:
+            raise ValueError(
+                "Fields %s and %s are not separated in the log format"
+                % (name, merged[i + 1][0])
+            )
+        tokens.append(
+            Field(
+                name,
+                regex,
+                converter=make_converter(kind, tz),
+                cached=kind in CACHED_TYPES,
+                kind=kind,
+            )
+        )
+    return Format(tokens)
+
+
+def compile_nginx_format(log_format: str, tz) -> Format:
+    items: List[Tuple[str, Optional[str]] | str] = []
+    pos = 0
+    for match in NGINX_VARIABLE.finditer(log_format):
+        items.append(log_format[pos : match.start()])
+        name = match.group(1) or match.group(2)
+        items.append((name, NGINX_VARIABLE_TYPES.get(name)))
+        pos = match.end()
+    items.append(log_format[pos:])
+    return make_format(items, tz)
+
+
+def compile_apache_format(log_format: str, tz) -> Format:
+    # Handle the escapes found in Apache configuration strings:
+    log_format = APACHE_ESCAPE.sub(
+        lambda match: APACHE_ESCAPES.get(match.group(1), match.group(1)), log_format
+    )
+    items: List[Tuple[str, Optional[str]] | str] = []
+    pos = 0
+    for match in APACHE_DIRECTIVE.finditer(log_format):
+        items.append(log_format[pos : match.start()])
+        pos = match.end()
+        parameter, directive = match.groups()
+        if directive == "%":
+            items.append("%")
+        elif directive == "t" and parameter is None:
+            items += ["[", ("time_local", "time_local"), "]"]
+        elif directive == "t" and parameter in APACHE_EPOCH_TYPES:
+            items.append(("time", APACHE_EPOCH_TYPES[parameter]))
+        elif directive == "T" and parameter in ("s", "ms", "us"):
+            items.append(("request_time_" + parameter, "int"))
+        elif parameter is not None and directive in APACHE_PARAMETRIZED_DIRECTIVES:
+            prefix, kind = APACHE_PARAMETRIZED_DIRECTIVES[directive]
+            name = prefix + re.sub("[^a-z0-9]", "_", parameter.lower())
+            items.append((name, kind))
+        elif parameter is None and directive in APACHE_DIRECTIVES:
+            items.append(APACHE_DIRECTIVES[directive])
+        else:
+            raise ValueError("Unsupported Apache log format directive " + match[0])
+    items.append(log_format[pos:])
+    return make_format(items, tz)
+
+
+def compile_log_format(log_format: str, syntax: str, tz) -> Format:
+    if log_format in LOG_FORMATS:
+        syntax, log_format = LOG_FORMATS[log_format]
+    if syntax == "auto":
+        syntax = "nginx" if NGINX_VARIABLE.search(log_format) else "apache"
+    if syntax == "nginx":
+        return compile_nginx_format(log_format, tz)
+    elif syntax == "apache":
+        return compile_apache_format(log_format, tz)
+    raise ValueError("Unexpected log format syntax " + syntax)
+
+
+# Conditions (--where) on the raw field values:
+
+CONDITION = re.compile(r"\s*(\w+)\s*(==|!=|>=|<=|=~|!~|=|<|>)\s*(.*?)\s*")
+
+CONDITION_OPERATORS = {
+    "=": operator.eq,
+    "==": operator.eq,
+    "!=": operator.ne,
+    ">=": operator.ge,
+    "<=": operator.le,
+    ">": operator.gt,
+    "<": operator.lt,
+}
+
+
+def compile_condition(expression: str) -> Tuple[str, Callable[[bytes], bool]]:
+    """Compile a condition such as "status>=500" or "path=~^/api/"
+
+    Numeric values are compared numerically (non-numeric raw values never
+    match), other values are compared as strings. "=~" and "!~" test
+    whether the value matches a regular expression.
+    """
+    name, test = _compile_string_condition(expression)
+    return name, lambda raw: test(decode(raw))
+
+
+def _compile_string_condition(expression: str) -> Tuple[str, Callable[[str], bool]]:
+    match = CONDITION.fullmatch(expression)
+    if match is None:
+        raise ValueError("Invalid condition " + expression)
+    name, op, value = match.groups()
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'":
+        value = value[1:-1]
+    elif op not in ("=~", "!~"):
+        try:
+            number = float(value)
+        except ValueError:
+            pass
+        else:
+            compare = CONDITION_OPERATORS[op]
+
+            def test_number(raw: str) -> bool:
+                try:
+                    return compare(float(raw), number)
+                except ValueError:
+                    return False
+
+            return name, test_number
+
+    if op == "=~":
+        return name, re.compile(value).search
+    elif op == "!~":
+        search = re.compile(value).search
+        return name, lambda raw: search(raw) is None
+    compare = CONDITION_OPERATORS[op]
+    return name, lambda raw: compare(raw, value)
+
+
+def load_format(args) -> Format:
+    tz = load_tz(args.tz)
+    if args.log_format is not None:
+        return compile_log_format(args.log_format, args.log_format_syntax, tz)
+    return make_combined_format_parser(tz)
+
+
+def split_names(values: Optional[List[str]]) -> List[str]:
+    return [name for value in values or [] for name in value.split(",") if name]
+
+
+def make_parser(
+    args, format: Optional[Format] = None, stats: Optional[Stats] = None
+) -> Callable[[bytes], Optional[dict]]:
+    if format is None:
+        format = load_format(args)
+    fields = None
+    if args.fields is not None:
+        fields = split_names(args.fields)
+    if is_aggregating(args):
+        fields = aggregated_fields(args, format.field_names)
+    conditions = [compile_condition(expression) for expression in args.where]
+    if args.since is not None or args.until is not None:
+        conditions.append(make_time_condition(args, format))
+    return format.parser(fields, conditions, args.cache_size, stats, args.debug)
+
+
+def report_cache_info(format: Format) -> None:
+    for name, info in format.cache_info().items():
+        total = info.hits + info.misses
+        sys.stderr.write(
+            "cache %s: %i hits, %i misses (%.1f%% hit rate), %i entries\n"
+            % (
+                name,
+                info.hits,
+                info.misses,
+                100 * info.hits / total if total else 0,
+                info.currsize,
+            )
+        )
+
+
+# Input is read in large blocks which are split in lines (without newline).
+
+READ_BLOCK_SIZE = 1024 * 1024
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+def read_lines(input: io.BufferedIOBase) -> Iterator[bytes]:
+    partial = b""
+    while True:
+        block = input.read1(READ_BLOCK_SIZE)
+        if not block:
+            break
+        lines = (partial + block).split(b"\n")
+        partial = lines.pop()
+        yield from lines
+    if partial:
+        yield partial
+
+
+def parse_lines(
+    lines: Iterable[bytes],
+    parse: Callable[[bytes], Optional[dict]],
+    raw: bool,
+    stats: Optional[Stats] = None,
+) -> Iterator[dict]:
+    for line in lines:
+        if stats is not None:
+            stats.lines_read += 1
+            stats.bytes_in += len(line) + 1
+            stats.tick()
+        if line.endswith(b"\r"):
+            line = line[:-1]
+        data = parse(line)
+        if data is None:
+            continue
+        if raw:
+            data["raw"] = decode(line)
+        yield data
+
+
+def convert_lines(
+    lines: Iterable[bytes],
+    parse: Callable[[bytes], Optional[dict]],
+    raw: bool,
+    stats: Optional[Stats] = None,
+) -> Iterator[str]:
+    if stats is None:
+        for data in parse_lines(lines, parse, raw):
+            yield dumps(data, default=json_mapper)
+        return
+    times = stats.times
+    for data in parse_lines(lines, parse, raw, stats):
+        start = timer()
+        line = dumps(data, default=json_mapper)
+        times["serialize"] += timer() - start
+        stats.bytes_out += len(line) + 1
+        yield line
+
+
+class LineWriter:
+    """Write lines to a binary output in large blocks"""
+
+    _output: io.BufferedIOBase
+    _lines: List[str]
+    size: int
+
+    def __init__(self, output: io.BufferedIOBase) -> None:
+        self._output = output
+        self._lines = []
+        self.size = 0
+
+    def write(self, line: str) -> None:
+        self._lines.append(line)
+        self.size += len(line) + 1
+        if self.size >= WRITE_BUFFER_SIZE:
+            self._write_buffer()
+
+    def write_lines(self, lines: Iterable[str]) -> None:
+        for line in lines:
+            self.write(line)
+
+    def write_block(self, data: bytes) -> None:
+        self._write_buffer()
+        self._output.write(data)
+
+    def _write_buffer(self) -> None:
+        if self._lines:
+            self._lines.append("")
+            self._output.write("\n".join(self._lines).encode(ENCODING))
+            self._lines.clear()
+            self.size = 0
+
+    def flush(self) -> None:
+        self._write_buffer()
+        self._output.flush()
+
+
+# Columnar output, as a NumPy .npz file (written without NumPy).
+#
+# Records are written in batches of rows. Each column of batch N is stored as
+# "N/column" (eg. "000000/status"). The type of a column is given by the type
+# of its field so that it is the same in every batch:
+#
+# * integers as int64 (-1 when missing);
+# * floats as float64 (NaN when missing);
+# * timestamps as datetime64[us] (NaT when missing);
+# * other values as strings, dictionary-encoded as "N/column.codes" (int32
+#   index, -1 when missing) and "N/column.values" (unique strings).
+#
+# Reading the status column of the first batch:
+#   numpy.load("access.npz")["000000/status"]
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+NAT = -(2**63)
+
+
+def npy_header(descr: str, length: int) -> bytes:
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%i,), }" % (
+        descr,
+        length,
+    )
+    # The header (including magic, version and length) is 64-byte aligned:
+    header += " " * (63 - (10 + len(header)) % 64) + "\n"
+    return b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little") + header.encode()
+
+
+def npy_array(typecode: str, values: Iterable) -> bytes:
+    data = array(typecode, values)
+    if sys.byteorder != "little":
+        data.byteswap()
+    return data.tobytes()
+
+
+def to_column_string(value: Any) -> str:
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (list, dict, int, float)):
+        return dumps(value, default=json_mapper)
+    return json_mapper(value)
+
+
+# Field type -> column type (other values are stored as strings):
+COLUMN_TYPES = {
+    "int": "int",
+    "float": "float",
+    "time_local": "time",
+    "time_iso8601": "time",
+    "epoch": "time",
+    "epoch_ms": "time",
+    "epoch_us": "time",
+}
+
+
+def column_types(args, format: Format) -> Dict[str, str]:
+    """Types of the output columns (of the records or of the rollups)"""
+    kinds = {name: format.get_field(name).kind for name in format.field_names}
+    if not is_aggregating(args):
+        return {name: COLUMN_TYPES.get(kind, "string") for name, kind in kinds.items()}
+    res = {}
+    if args.bucket:
+        res["bucket"] = "time"
+    for name, depth in parse_group_by(args):
+        res[name] = COLUMN_TYPES.get(kinds.get(name), "string")
+    res["count"] = "int"
+    for name in split_names(args.sum):
+        float_sum = kinds.get(name) in ("float", "float_list")
+        res[name + "_sum"] = "float" if float_sum else "int"
+    return res
+
+
+class NpzWriter:
+    _zip: zipfile.ZipFile
+    _batch_size: int
+    _types: Dict[str, str]
+    _batch: List[dict]
+    _batch_count: int
+
+    def __init__(self, output, batch_size: int, types: Dict[str, str]) -> None:
+        self._zip = zipfile.ZipFile(output, "w")
+        self._batch_size = batch_size
+        self._types = types
+        self._batch = []
+        self._batch_count = 0
+
+    def write(self, record: dict) -> None:
+        self._batch.append(record)
+        if len(self._batch) >= self._batch_size:
+            self.flush()
+
+    def _write_array(self, name: str, descr: str, length: int, data: bytes) -> None:
+        prefix = "%06i/" % self._batch_count
+        with self._zip.open(prefix + name + ".npy", "w", force_zip64=True) as f:
+            f.write(npy_header(descr, length))
+            f.write(data)
+
+    def _write_column(self, name: str, values: List[Any]) -> None:
+        n = len(values)
+        column_type = self._types.get(name, "string")
+        if column_type == "int":
+            data = npy_array("q", (-1 if value is None else value for value in values))
+            self._write_array(name, "<i8", n, data)
+        elif column_type == "float":
+            data = npy_array(
+                "d", (float("nan") if value is None else value for value in values)
+            )
+            self._write_array(name, "<f8", n, data)
+        elif column_type == "time":
+            data = npy_array(
+                "q",
+                (
+                    (
+                        NAT
+                        if value is None
+                        else (value - EPOCH) // timedelta(microseconds=1)
+                    )
+                    for value in values
+                ),
+            )
+            self._write_array(name, "<M8[us]", n, data)
+        else:
+            dictionary: dict = {}
+            codes = npy_array(
+                "i",
+                (
+                    (
+                        -1
+                        if value is None
+                        else dictionary.setdefault(
+                            to_column_string(value), len(dictionary)
+                        )
+                    )
+                    for value in values
+                ),
+            )
+            self._write_array(name + ".codes", "<i4", n, codes)
+            width = max((len(value) for value in dictionary), default=0) or 1
+            strings = "".join(value.ljust(width, "\0") for value in dictionary)
+            self._write_array(
+                name + ".values",
+                "<U%i" % width,
+                len(dictionary),
+                strings.encode("utf-32-le", errors="surrogatepass"),
+            )
+
+    def flush(self) -> None:
+        if not self._batch:
+            return
+        batch = self._batch
+        self._batch = []
+        names: dict = {}
+        for record in batch:
+            for name in record:
+                names[name] = None
+        for name in names:
+            self._write_column(name, [record.get(name) for record in batch])
+        self._batch_count += 1
+
+    def close(self) -> None:
+        self.flush()
+        self._zip.close()
+
+
+# Aggregation (--group-by, --bucket, --sum):
+
+TIME_FIELDS = ["timestamp", "time_local", "time_iso8601", "msec", "time"]
+
+
+def is_aggregating(args) -> bool:
+    return bool(args.group_by or args.sum or args.bucket)
+
+
+def parse_group_by(args) -> List[Tuple[str, Optional[int]]]:
+    """Parse the --group-by fields ("name" or "name:depth" for path prefixes)"""
+    res = []
+    for spec in split_names(args.group_by):
+        name, sep, depth = spec.partition(":")
+        res.append((name, int(depth) if sep else None))
+    return res
+
+
+def find_time_field(names: List[str]) -> str:
+    for name in TIME_FIELDS:
+        if name in names:
+            return name
+    raise ValueError("No timestamp field in log format")
+
+
+def aggregated_fields(args, names: List[str]) -> List[str]:
+    fields = [name for name, depth in parse_group_by(args)] + split_names(args.sum)
+    if args.bucket:
+        fields.append(find_time_field(names))
+    return list(dict.fromkeys(fields))
+
+
+def path_prefix(value: Any, depth: Optional[int]) -> Any:
+    if depth is None or not isinstance(value, str):
+        return value
+    return "/".join(value.split("?", 1)[0].split("/")[: depth + 1])
+
+
+class Aggregator:
+    """Count entries and sum fields per time bucket and group
+
+    Rollups are emitted when their time bucket is complete. In order to
+    accommodate slightly out of order entries, a bucket is only considered
+    complete when an entry from two buckets later is seen. Entries arriving
+    after their bucket was emitted are dropped (and counted as "late" in the
+    statistics).
+    """
+
+    _group_by: List[Tuple[str, Optional[int]]]
+    _sums: List[str]
+    _bucket: Optional[float]
+    _time_field: Optional[str]
+    _tz: Any
+    _emit: Callable[[dict], None]
+    _stats: Optional[Stats]
+    _buckets: dict
+    _latest: float
+    _flushed: float
+
+    def __init__(
+        self,
+        group_by: List[Tuple[str, Optional[int]]],
+        sums: List[str],
+        bucket: Optional[float],
+        time_field: Optional[str],
+        tz,
+        emit: Callable[[dict], None],
+        stats: Optional[Stats] = None,
+    ) -> None:
+        self._group_by = group_by
+        self._sums = sums
+        self._bucket = bucket
+        self._time_field = time_field
+        self._tz = tz
+        self._emit = emit
+        self._stats = stats
+        self._buckets = {}
+        self._latest = -math.inf
+        # The buckets starting before this time were emitted:
+        self._flushed = -math.inf
+
+    def add(self, record: dict) -> None:
+        start = None
+        if self._bucket:
+            timestamp = record.get(self._time_field)
+            if timestamp is None:
+                return
+            start = timestamp.timestamp() // self._bucket * self._bucket
+            if start < self._flushed:
+                if self._stats is not None:
+                    self._stats.reject("late")
+                return
+            if start > self._latest:
+                self._latest = start
+                self.flush(start - self._bucket)
+        key = tuple(
+            path_prefix(record.get(name), depth) for name, depth in self._group_by
+        )
+        groups = self._buckets.setdefault(start, {})
+        values = groups.get(key)
+        if values is None:
+            values = groups[key] = [0] * (len(self._sums) + 1)
+        values[0] += 1
+        for i, name in enumerate(self._sums):
+            value = record.get(name)
+            if isinstance(value, (int, float)):
+                values[i + 1] += value
+
+    def flush(self, before: Optional[float] = None) -> None:
+        """Emit the rollups of the buckets starting before a given time (or all)"""
+        if before is not None:
+            self._flushed = max(self._flushed, before)
+        for start in sorted(
+            start
+            for start in self._buckets
+            if before is None or start is None or start < before
+        ):
+            for key, values in self._buckets.pop(start).items():
+                rollup = {}
+                if start is not None:
+                    rollup["bucket"] = datetime.fromtimestamp(start, self._tz)
+                for (name, depth), value in zip(self._group_by, key):
+                    rollup[name] = value
+                rollup["count"] = values[0]
+                for name, value in zip(self._sums, values[1:]):
+                    rollup[name + "_sum"] = value
+                self._emit(rollup)
+
+
+def make_aggregator(
+    args, format: Format, emit: Callable[[dict], None], stats: Optional[Stats] = None
+) -> Aggregator:
+    return Aggregator(
+        parse_group_by(args),
+        split_names(args.sum),
+        args.bucket,
+        find_time_field(format.field_names) if args.bucket else None,
+        load_tz(args.tz),
+        emit,
+        stats,
+    )
+
+
+# Time range (--since, --until):
+#
+# Logs are assumed to be roughly ordered by time. The start and end of the time
+# range in regular files is found by binary search (probing the timestamp of the
+# line following a given offset). Entries are up to TIME_SLACK out of order.
+# The timestamps of the entries are then checked individually.
+#
+# With --index, a sidecar file (FILE.tsidx) stores sparse (offset, timestamp)
+# samples of the file which are used to narrow the search.
+
+TIME_SLACK = timedelta(minutes=1)
+SEARCH_BLOCK_SIZE = 64 * 1024
+INDEX_STEP = 4 * 1024 * 1024
+INDEX_SUFFIX = ".tsidx"
+
+
+def parse_time_arg(value: str, tz) -> datetime:
+    res = datetime.fromisoformat(value)
+    if res.tzinfo is None:
+        res = res.replace(tzinfo=tz)
+    return res
+
+
+def make_time_condition(args, format: Format) -> Tuple[str, Callable[[bytes], bool]]:
+    tz = load_tz(args.tz)
+    since = None if args.since is None else parse_time_arg(args.since, tz)
+    until = None if args.until is None else parse_time_arg(args.until, tz)
+    field = format.get_field(find_time_field(format.field_names))
+    # Share the cache of the field (the timestamp is usually selected as well):
+    converter = format._converter(field, args.cache_size)
+
+    def test(raw: bytes) -> bool:
+        try:
+            timestamp = converter(raw)
+        except ValueError:
+            return False
+        if timestamp is None:
+            return False
+        return (since is None or timestamp >= since) and (
+            until is None or timestamp < until
+        )
+
+    return field.name, test
+
+
+def make_timestamp_reader(format: Format) -> Callable[[bytes], Optional[float]]:
+    name = find_time_field(format.field_names)
+    parse = format.parser([name])
+
+    def read_timestamp(line: bytes) -> Optional[float]:
+        data = parse(line.rstrip(b"\n").rstrip(b"\r"))
+        if data is None or data[name] is None:
+            return None
+        return data[name].timestamp()
+
+    return read_timestamp
+
+
+def probe_timestamp(
+    f: io.BufferedReader,
+    offset: int,
+    read_timestamp: Callable[[bytes], Optional[float]],
+    max_lines: int = 16,
+) -> Tuple[int, Optional[float]]:
+    """Find the first timestamp after a given offset
+
+    Returns the offset of the start of the line and its timestamp (or None).
+    """
+    f.seek(offset)
+    if offset != 0:
+        f.seek(offset - 1)
+        f.readline()
+    line_start = f.tell()
+    for i in range(max_lines):
+        line = f.readline()
+        if not line:
+            break
+        timestamp = read_timestamp(line)
+        if timestamp is not None:
+            return line_start, timestamp
+        line_start = f.tell()
+    return line_start, None
+
+
+def find_offset(
+    f: io.BufferedReader,
+    size: int,
+    target: float,
+    read_timestamp: Callable[[bytes], Optional[float]],
+    samples: List[Tuple[int, float]],
+) -> int:
+    """Find the offset of a line starting (approximately) before a timestamp"""
+    low = 0
+    high = size
+    for offset, timestamp in samples:
+        if timestamp < target:
+            low = max(low, offset)
+        else:
+            high = min(high, offset)
+            break
+    while high - low > SEARCH_BLOCK_SIZE:
+        middle = (low + high) // 2
+        line_start, timestamp = probe_timestamp(f, middle, read_timestamp)
+        if timestamp is None or timestamp >= target or line_start >= high:
+            high = middle
+        else:
+            low = line_start
+    return low
+
+
+def load_time_index(
+    filename: str,
+    f: io.BufferedReader,
+    read_timestamp: Callable[[bytes], Optional[float]],
+) -> List[Tuple[int, float]]:
+    """Load (and create or extend) the sidecar index of a file"""
+    st = os.fstat(f.fileno())
+    index_filename = filename + INDEX_SUFFIX
+    index = None
+    try:
+        with open(index_filename, "rt") as index_file:
+            index = json.load(index_file)
+    except (FileNotFoundError, ValueError):
+        pass
+    if (
+        index is None
+        or index.get("inode") != [st.st_dev, st.st_ino]
+        or index["size"] > st.st_size
+    ):
+        index = {"inode": [st.st_dev, st.st_ino], "size": 0, "samples": []}
+    if index["size"] == st.st_size:
+        return [tuple(sample) for sample in index["samples"]]
+
+    samples = index["samples"]
+    offset = samples[-1][0] + INDEX_STEP if samples else 0
+    while offset < st.st_size:
+        line_start, timestamp = probe_timestamp(f, offset, read_timestamp)
+        if timestamp is not None and (not samples or line_start > samples[-1][0]):
+            samples.append([line_start, timestamp])
+        offset = max(offset, line_start) + INDEX_STEP
+    index["size"] = st.st_size
+    try:
+        tmp_filename = index_filename + ".tmp"
+        with open(tmp_filename, "wt") as index_file:
+            json.dump(index, index_file)
+        os.replace(tmp_filename, index_filename)
+    except OSError as e:
+        sys.stderr.write("Could not write index %s: %s\n" % (index_filename, e))
+    return [tuple(sample) for sample in samples]
+
+
+def find_time_range(args, format: Format, filename: str) -> Tuple[int, int]:
+    """Find the byte range of a file containing the --since/--until range"""
+    tz = load_tz(args.tz)
+    read_timestamp = make_timestamp_reader(format)
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        samples = []
+        if args.index:
+            samples = load_time_index(filename, f, read_timestamp)
+        start = 0
+        end = size
+        if args.since is not None:
+            since = parse_time_arg(args.since, tz) - TIME_SLACK
+            start = find_offset(f, size, since.timestamp(), read_timestamp, samples)
+        if args.until is not None:
+            until = parse_time_arg(args.until, tz) + TIME_SLACK
+            end = find_offset(f, size, until.timestamp(), read_timestamp, samples)
+            # The line found may be before the last line of the range:
+            end = probe_timestamp(
+                f, min(end + SEARCH_BLOCK_SIZE, size), read_timestamp
+            )[0]
+    return start, max(start, end)
+
+
+class RangeReader(io.RawIOBase):
+    """Read a byte range of a file"""
+
+    _file: io.BufferedReader
+    _remaining: int
+
+    def __init__(self, file: io.BufferedReader, start: int, end: int) -> None:
+        self._file = file
+        self._file.seek(start)
+        self._remaining = end - start
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        n = self._file.readinto(memoryview(buffer)[: self._remaining])
+        self._remaining -= n
+        return n
+
+    def close(self) -> None:
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+def open_range(filename: str, start: int, end: int) -> io.BufferedReader:
+    return io.BufferedReader(RangeReader(open(filename, "rb"), start, end))
+
+
+# Compressed input is decompressed in a background thread and the blocks are
+# passed to the parser through a bounded queue.
+
+COMPRESSION_MAGICS = {
+    b"\x1f\x8b": "gzip",
+    b"BZh": "bz2",
+    b"\xfd7zXZ\x00": "xz",
+    b"\x28\xb5\x2f\xfd": "zstd",
+}
+
+DECOMPRESSION_BLOCK_SIZE = 256 * 1024
+DECOMPRESSION_QUEUE_SIZE = 16
+
+
+def detect_compression(input: io.BufferedReader) -> Optional[str]:
+    head = input.peek(6)
+    for magic, compression in COMPRESSION_MAGICS.items():
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def make_decompressor(compression: str):
+    if compression == "gzip":
+        return zlib.decompressobj(wbits=31)
+    elif compression == "bz2":
+        return bz2.BZ2Decompressor()
+    elif compression == "xz":
+        return lzma.LZMADecompressor()
+    elif compression == "zstd":
+        try:
+            from compression import zstd  # Python 3.14
+
+            return zstd.ZstdDecompressor()
+        except ImportError:
+            pass
+        import zstandard
+
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError("Unexpected compression " + compression)
+
+
+def decompress_blocks(input: io.BufferedReader, compression: str) -> Iterator[bytes]:
+    decompressor = make_decompressor(compression)
+    started = False
+    while True:
+        data = input.read(DECOMPRESSION_BLOCK_SIZE)
+        if not data:
+            break
+        started = True
+        # Handle concatenated streams (eg. "cat a.gz b.gz"):
+        while data:
+            block = decompressor.decompress(data)
+            if block:
+                yield block
+            if decompressor.eof:
+                data = decompressor.unused_data
+                decompressor = make_decompressor(compression)
+                started = data != b""
+            else:
+                data = b""
+    if started:
+        raise EOFError("Compressed input ended before the end-of-stream marker")
+
+
+class DecompressingReader(io.RawIOBase):
+    _input: io.BufferedReader
+    _close_input: bool
+    _queue: queue.Queue
+    _closed: threading.Event
+    _buffer: memoryview
+    _eof: bool
+
+    def __init__(
+        self, input: io.BufferedReader, compression: str, close_input: bool = True
+    ) -> None:
+        self._input = input
+        self._close_input = close_input
+        self._queue = queue.Queue(DECOMPRESSION_QUEUE_SIZE)
+        self._closed = threading.Event()
+        self._buffer = memoryview(b"")
+        self._eof = False
+        threading.Thread(target=self._run, args=(compression,), daemon=True).start()
+
+    def _put(self, item) -> bool:
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self, compression: str) -> None:
+        try:
+            for block in decompress_blocks(self._input, compression):
+                if not self._put(block):
+                    return
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while len(self._buffer) == 0:
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+                return 0
+            if isinstance(item, OSError):
+                self._eof = True
+                raise item
+            if isinstance(item, Exception):
+                # Report the decompression errors (truncated or corrupt data)
+                # like the other input errors:
+                self._eof = True
+                raise OSError(str(item)) from item
+            self._buffer = memoryview(item)
+        n = min(len(buffer), len(self._buffer))
+        buffer[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self) -> None:
+        if not self.closed:
+            self._closed.set()
+            if self._close_input:
+                self._input.close()
+        super().close()
+
+
+def open_input(infile: str) -> io.BufferedReader:
+    """Open an input file (or stdin), transparently decompressing it"""
+    if infile == "-":
+        binary = sys.stdin.buffer
+    else:
+        binary = open(infile, "rb")
+    compression = detect_compression(binary)
+    if compression is None:
+        return binary
+    reader = DecompressingReader(binary, compression, close_input=infile != "-")
+    return io.BufferedReader(reader, DECOMPRESSION_BLOCK_SIZE)
+
+
+# Parallel mode: regular files are split in chunks (ending on a line boundary)
+# which are parsed in worker processes.
+
+
+_worker_args = None
+_worker_parse = None
+_worker_stats = None
+
+
+def _init_worker(args) -> None:
+    global _worker_args, _worker_parse, _worker_stats
+    _worker_args = args
+    if linestats.enabled(args):
+        _worker_stats = Stats()
+    _worker_parse = make_parser(args, stats=_worker_stats)
+    linestats.ignore_interrupt()
+
+
+def _parse_chunk(
+    filename: str, start: int, end: int
+) -> Tuple[bytes | List[dict], Optional[dict]]:
+    """Parse a chunk of a file
+
+    Returns the JSON lines output (or the records) and the statistics.
+    """
+    with open(filename, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    lines = data.split(b"\n")
+    if lines[-1] == b"":
+        lines.pop()
+    args = _worker_args
+    if args.output_format != "jsonl" or is_aggregating(args):
+        res = list(parse_lines(lines, _worker_parse, args.raw, _worker_stats))
+    else:
+        output = convert_lines(lines, _worker_parse, args.raw, _worker_stats)
+        res = "".join(line + "\n" for line in output).encode(ENCODING)
+    return res, None if _worker_stats is None else _worker_stats.pop()
+
+
+def parse_chunks(
+    executor: ProcessPoolExecutor,
+    filename: str,
+    chunks: List[Tuple[int, int]],
+    window: int,
+    ordered: bool,
+) -> Iterator[Tuple[bytes | List[dict], Optional[dict]]]:
+    """Parse the chunks of a file in the worker processes.
+
+    At most `window` chunks are in flight (see linestats.map_ordered). If
+    `ordered` is false, the output of each chunk is yielded as soon as it is
+    available.
+    """
+    if ordered:
+        tasks = ((filename, start, end) for start, end in chunks)
+        yield from map_ordered(executor, _parse_chunk, tasks, window)
+    else:
+        pending = set()
+        for start, end in chunks:
+            if len(pending) >= window:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(_parse_chunk, filename, start, end))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def is_splittable(filename: str) -> bool:
+    """Whether a file can be split in chunks for parallel parsing"""
+    if filename == "-" or not stat.S_ISREG(os.stat(filename).st_mode):
+        return False
+    with open(filename, "rb") as f:
+        return detect_compression(f) is None
+
+
+# Follow mode (like "tail -F"):
+
+FOLLOW_READ_SIZE = 1024 * 1024
+FOLLOW_FLUSH_SIZE = 1024 * 1024
+
+
+class FollowedFile:
+    """Follow a file across rotations (new inode) and truncations
+
+    `offset` is the position after the last complete line which was read.
+    """
+
+    path: str
+    file: Optional[io.BufferedReader]
+    inode: Optional[Tuple[int, int]]
+    offset: int
+    _partial: bytes
+
+    def __init__(self, path: str, checkpoint: Optional[dict] = None) -> None:
+        self.path = path
+        self.file = None
+        self.inode = None
+        self.offset = 0
+        self._partial = b""
+        self._open(checkpoint)
+
+    def _open(self, checkpoint: Optional[dict] = None) -> None:
+        try:
+            self.file = open(self.path, "rb")
+        except FileNotFoundError:
+            self.file = None
+            return
+        st = os.fstat(self.file.fileno())
+        self.inode = (st.st_dev, st.st_ino)
+        self.offset = 0
+        self._partial = b""
+        if (
+            checkpoint is not None
+            and (checkpoint["dev"], checkpoint["ino"]) == self.inode
+            and checkpoint["offset"] <= st.st_size
+        ):
+            self.offset = checkpoint["offset"]
+            self.file.seek(self.offset)
+
+    def checkpoint(self) -> Optional[dict]:
+        if self.inode is None:
+            return None
+        return {"dev": self.inode[0], "ino": self.inode[1], "offset": self.offset}
+
+    def read_lines(self) -> List[bytes]:
+        if self.file is None:
+            self._open()
+            if self.file is None:
+                return []
+        data = self.file.read(FOLLOW_READ_SIZE)
+        if data:
+            data = self._partial + data
+            end = data.rfind(b"\n") + 1
+            self._partial = data[end:]
+            self.offset += end
+            return data[:end].split(b"\n")[:-1]
+
+        # End of file, check for rotation or truncation:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return []
+        if (st.st_dev, st.st_ino) != self.inode:
+            lines = [self._partial] if self._partial else []
+            self.file.close()
+            self._open()
+            return lines
+        if st.st_size < self.file.tell():
+            self.file.seek(0)
+            self.offset = 0
+            self._partial = b""
+        return []
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+
+
+def load_checkpoint(path: Optional[str]) -> dict:
+    if path is None:
+        return {}
+    try:
+        with open(path, "rt") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_checkpoint(path: Optional[str], checkpoint: dict) -> None:
+    if path is None:
+        return
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wt") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def follow(
+    args,
+    parse: Callable[[bytes], Optional[dict]],
+    format: Format,
+    stats: Optional[Stats] = None,
+) -> None:
+    """Follow the input files and flush the output in batches
+
+    The output is flushed when it gets big enough, when no more data is
+    available or at least every `--flush-interval` seconds.
+    The checkpoint file is updated after each flush.
+    """
+    checkpoint = load_checkpoint(args.checkpoint)
+    followed = [
+        FollowedFile(path, checkpoint.get(os.path.abspath(path)))
+        for path in args.infiles
+    ]
+    writer = LineWriter(sys.stdout.buffer)
+    last_flush = time.monotonic()
+
+    def emit(record: dict) -> None:
+        line = dumps(record, default=json_mapper)
+        if stats is not None:
+            stats.bytes_out += len(line) + 1
+        writer.write(line)
+
+    aggregator = None
+    if is_aggregating(args):
+        aggregator = make_aggregator(args, format, emit, stats)
+
+    def flush() -> None:
+        nonlocal last_flush
+        writer.flush()
+        last_flush = time.monotonic()
+        new_checkpoint = {
+            os.path.abspath(file.path): file.checkpoint() for file in followed
+        }
+        if new_checkpoint != checkpoint:
+            save_checkpoint(args.checkpoint, new_checkpoint)
+            checkpoint.clear()
+            checkpoint.update(new_checkpoint)
+
+    try:
+        while True:
+            idle = True
+            for file in followed:
+                lines = file.read_lines()
+                if lines:
+                    idle = False
+                for record in parse_lines(lines, parse, args.raw, stats):
+                    if aggregator is not None:
+                        aggregator.add(record)
+                    else:
+                        emit(record)
+            if idle and aggregator is not None and args.bucket:
+                # Time is advancing even without traffic:
+                aggregator.flush(time.time() - 2 * args.bucket)
+            if (
+                idle
+                or writer.size >= FOLLOW_FLUSH_SIZE
+                or time.monotonic() - last_flush >= args.flush_interval
+            ):
+                flush()
+            if idle:
+                if stats is not None:
+                    stats.maybe_report()
+                time.sleep(args.poll_interval)
+    finally:
+        if aggregator is not None:
+            aggregator.flush()
+        flush()
+        for file in followed:
+            file.close()
+        if args.debug:
+            report_cache_info(format)
+        if stats is not None:
+            stats.report(final=True)
+
+
 def main():
 
     parser = ArgumentParser(
@@ -139,39 +1850,248 @@ def main():
         "--debug", default=False, action=BooleanOptionalAction, help="Include raw line"
     )
     parser.add_argument("--tz", default="UTC", help="Timezone")
+    parser.add_argument(
+        "--log-format",
+        help="nginx log_format or Apache LogFormat string"
+        + " (or one of: "
+        + ", ".join(LOG_FORMATS)
+        + ")",
+    )
+    parser.add_argument(
+        "--log-format-syntax",
+        choices=["auto", "nginx", "apache"],
+        default="auto",
+        help="Syntax of --log-format",
+    )
+    parser.add_argument(
+        "--fields",
+        action="append",
+        help="Comma-separated list of fields to output",
+    )
+    parser.add_argument(
+        "--where",
+        action="append",
+        default=[],
+        help="Only output entries matching a condition on a raw field value"
+        + " (eg. status>=500, path=~^/api/), may be repeated",
+    )
+    parser.add_argument(
+        "--since",
+        help="Only output entries at or after this time (ISO 8601)",
+    )
+    parser.add_argument(
+        "--until",
+        help="Only output entries before this time (ISO 8601)",
+    )
+    parser.add_argument(
+        "--index",
+        default=False,
+        action=BooleanOptionalAction,
+        help="With --since/--until, use (and maintain) a FILE"
+        + INDEX_SUFFIX
+        + " sidecar index",
+    )
+    parser.add_argument(
+        "--group-by",
+        action="append",
+        help="Output counts per group of comma-separated fields"
+        + " (use path:N to group on the first N path segments)",
+    )
+    parser.add_argument(
+        "--sum",
+        action="append",
+        help="With aggregation, comma-separated list of fields to sum",
+    )
+    parser.add_argument(
+        "--bucket",
+        type=float,
+        help="Aggregate per time bucket of the given duration (in seconds)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=CACHE_SIZE,
+        help="Size of the per-field caches of converted values (0 to disable),"
+        + " hit rates are reported with --debug",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of worker processes for parsing regular files",
+    )
+    parser.add_argument(
+        "--unordered",
+        default=False,
+        action=BooleanOptionalAction,
+        help="With --jobs, write output as soon as available (not in input order)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=16 * 1024 * 1024,
+        help="With --jobs, size of the chunks (in bytes) sent to the workers",
+    )
+    parser.add_argument(
+        "--follow",
+        "-F",
+        default=False,
+        action=BooleanOptionalAction,
+        help="Follow the input files across rotations (like tail -F)",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="With --follow, file used to save and resume the input positions",
+    )
+    parser.add_argument(
+        "--flush-interval",
+        type=float,
+        default=1.0,
+        help="With --follow, maximum delay (in seconds) before flushing output",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=0.25,
+        help="With --follow, delay (in seconds) between checks for new data",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=["jsonl", "npz"],
+        default="jsonl",
+        help="Output format: JSON lines or columnar batches (NumPy .npz)",
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        default="-",
+        help="Output file for --output-format=npz",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=65536,
+        help="Number of rows per batch for columnar output",
+    )
+    linestats.add_arguments(parser)
     args = parser.parse_args()
     debug = args.debug
     raw = args.raw
     infiles = args.infiles
-    tz = load_tz(args.tz)
+    jobs = args.jobs
 
-    parse = make_combined_format_parser(tz).parse
+    stats = linestats.from_args(args)
+    try:
+        format = load_format(args)
+        parse = make_parser(args, format, stats)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.unordered and is_aggregating(args):
+        # Out of order chunks would split the time buckets:
+        parser.error("--unordered cannot be used with --group-by, --sum or --bucket")
 
     # Correctly die on broken pipe:
     signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
-    for infile in infiles:
+    if args.follow:
+        if "-" in infiles:
+            parser.error("--follow cannot be used with standard input")
+        if args.output_format != "jsonl":
+            parser.error("--follow only supports JSON lines output")
+        # Save the checkpoint on termination:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            follow(args, parse, format, stats)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    executor = None
+    if jobs > 1:
+        executor = ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(args,))
 
-        if infile == "-":
-            input = sys.stdin
-        else:
-            input = open(infile, "rt")
+    writer = None
+    output = LineWriter(sys.stdout.buffer)
+    if args.output_format == "npz":
+        writer = NpzWriter(
+            sys.stdout.buffer if args.output == "-" else args.output,
+            args.batch_size,
+            column_types(args, format),
+        )
+        emit = writer.write
+    else:
+        emit = lambda record: output.write(dumps(record, default=json_mapper))
+
+    aggregator = None
+    if is_aggregating(args):
+        aggregator = make_aggregator(args, format, emit, stats)
+        emit = aggregator.add
+
+    def convert_file(infile: str) -> None:
+        start, end = 0, None
+        splittable = is_splittable(infile)
+        if splittable and (args.since is not None or args.until is not None):
+            start, end = find_time_range(args, format, infile)
 
+        if executor is not None and splittable:
+            chunks = split_chunks(infile, args.chunk_size, start, end)
+            for result, counters in parse_chunks(
+                executor, infile, chunks, 2 * jobs, not args.unordered
+            ):
+                if counters is not None:
+                    stats.merge(counters)
+                    stats.maybe_report()
+                if isinstance(result, bytes):
+                    output.write_block(result)
+                else:
+                    for record in result:
+                        emit(record)
+            return
+
+        if end is not None:
+            input = open_range(infile, start, end)
+        else:
+            input = open_input(infile)
         try:
-            for line in input:
-                line = line.rstrip("\n")
-                data = parse(line)
-                if data is None:
-                    if debug:
-                        sys.stderr.write(line + "\n")
-                    continue
-                if raw:
-                    data["raw"] = line
-                print(dumps(data, default=json_mapper))
+            lines = read_lines(input)
+            if writer is None and aggregator is None:
+                output.write_lines(convert_lines(lines, parse, raw, stats))
+            else:
+                for record in parse_lines(lines, parse, raw, stats):
+                    emit(record)
         finally:
-            if infile != "-":
+            if input is not sys.stdin.buffer:
                 input.close()
 
+    status = 0
+    try:
+        for infile in infiles:
+            try:
+                convert_file(infile)
+            except OSError as e:
+                # Eg. a truncated compressed file (still being written):
+                output.flush()
+                sys.stderr.write("accesslog2jsonl: %s: %s\n" % (infile, e))
+                status = 1
+        if aggregator is not None:
+            aggregator.flush()
+        if debug:
+            report_cache_info(format)
+        if stats is not None:
+            stats.report(final=True)
+    finally:
+        # Do not lose the records already parsed (eg. on interruption):
+        try:
+            if writer is not None:
+                writer.close()
+        finally:
+            output.flush()
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+    sys.exit(status)
+
 
 if __name__ == "__main__":
     main()
@@ -1,8 +1,8 @@
 #!/usr/bin/python3
+#
+# Convert CBOR to JSON (see dataconv.py)
 
-import sys
-import json
-import cbor
+from dataconv import main
 
-obj = cbor.load(sys.stdin.buffer)
-json.dump(obj, sys.stdout)
+if __name__ == "__main__":
+    main("cbor", "json")
@@ -0,0 +1,233 @@
+#!/usr/bin/python3
+"""
+Benchmark the dataconv.py codecs (JSON, YAML, MessagePack, CBOR).
+
+For each corpus and each codec, measure the encoding and decoding
+throughput, the peak RSS and the size of the encoded data. Each measurement
+runs in a new process (so that the peak RSS is meaningful). Results are
+written as JSON and can be compared with a previous run (--compare).
+
+    dataconv-bench.py [--corpus FILE] [--codec NAME] [--output results.json]
+
+Synthetic corpora: deep nesting, wide objects, many small records, large
+strings and large binary payloads. Other corpora can be given as files
+(loaded according to their extension).
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Any, Dict, List, Optional
+
+from dataconv import CODECS
+
+
+def make_deep(scale: int) -> Any:
+    obj: Any = "leaf"
+    for i in range(100 * scale):
+        obj = {"level": i, "child": obj}
+    return obj
+
+
+def make_wide(scale: int) -> Any:
+    return {"key%i" % i: i for i in range(100000 * scale)}
+
+
+def make_records(scale: int) -> Any:
+    return [
+        {
+            "id": i,
+            "time": 1700000000.0 + i,
+            "host": "10.0.%i.%i" % (i // 256 % 256, i % 256),
+            "path": "/api/v1/items/%i" % i,
+            "status": 200 if i % 10 else 500,
+            "tags": ["a", "b", "c"][: i % 4],
+            "ok": i % 10 != 0,
+        }
+        for i in range(50000 * scale)
+    ]
+
+
+def make_strings(scale: int) -> Any:
+    return ["%06i" % i * 16384 for i in range(10 * scale)]
+
+
+def make_binary(scale: int) -> Any:
+    return [os.urandom(1024 * 1024) for i in range(10 * scale)]
+
+
+CORPORA = {
+    "deep": make_deep,
+    "wide": make_wide,
+    "records": make_records,
+    "strings": make_strings,
+    "binary": make_binary,
+}
+
+
+def codec_for_file(filename: str):
+    for codec in CODECS.values():
+        if filename.endswith(codec.extensions):
+            return codec
+    raise ValueError("Unknown file extension: " + filename)
+
+
+def load_corpus(corpus: str, scale: int) -> Any:
+    if corpus in CORPORA:
+        return CORPORA[corpus](scale)
+    with open(corpus, "rb") as f:
+        return codec_for_file(corpus).load(io.BufferedReader(f))
+
+
+def peak_rss() -> int:
+    """Peak RSS of the current process (in KiB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _measure(codec_name: str, corpus: str, scale: int, repeat: int) -> dict:
+    """Measure a codec on a corpus (in a new process)"""
+    codec = CODECS[codec_name]
+    # Import the library before measuring:
+    codec.lib
+    obj = load_corpus(corpus, scale)
+    rss_before = peak_rss()
+
+    encode_time = None
+    for i in range(repeat):
+        output = io.BytesIO()
+        start = time.perf_counter()
+        codec.dump(obj, output)
+        duration = time.perf_counter() - start
+        encode_time = duration if encode_time is None else min(encode_time, duration)
+    data = output.getvalue()
+    del output
+
+    decode_time = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        codec.load(io.BytesIO(data))
+        duration = time.perf_counter() - start
+        decode_time = duration if decode_time is None else min(decode_time, duration)
+
+    size = len(data)
+    return {
+        "size": size,
+        "encode_time": encode_time,
+        "decode_time": decode_time,
+        "encode_mb_per_s": size / encode_time / 1e6 if encode_time else None,
+        "decode_mb_per_s": size / decode_time / 1e6 if decode_time else None,
+        "peak_rss_kib": peak_rss(),
+        "corpus_rss_kib": rss_before,
+    }
+
+
+def measure(codec_name: str, corpus: str, scale: int, repeat: int) -> dict:
+    result = {"codec": codec_name, "corpus": corpus}
+    context = get_context("spawn")
+    with ProcessPoolExecutor(1, mp_context=context) as executor:
+        try:
+            result.update(
+                executor.submit(_measure, codec_name, corpus, scale, repeat).result()
+            )
+        except Exception as e:
+            # Missing library, unsupported types (eg. bytes in JSON), etc.
+            result["error"] = "%s: %s" % (type(e).__name__, e)
+    return result
+
+
+def library_versions(codecs: List[str]) -> Dict[str, Optional[str]]:
+    versions = {}
+    for name in codecs:
+        try:
+            lib = CODECS[name].lib
+        except ImportError:
+            versions[name] = None
+            continue
+        versions[name] = getattr(lib, "__version__", None)
+        if versions[name] is None and hasattr(lib, "version"):
+            versions[name] = ".".join(str(x) for x in lib.version)
+    return versions
+
+
+def compare(results: List[dict], baseline: List[dict]) -> None:
+    """Write the ratios to a previous run (new / old) to stderr"""
+    old = {(result["codec"], result["corpus"]): result for result in baseline}
+    keys = ["encode_mb_per_s", "decode_mb_per_s", "size", "peak_rss_kib"]
+    sys.stderr.write("%-10s %-12s %s\n" % ("codec", "corpus", " ".join(keys)))
+    for result in results:
+        previous = old.get((result["codec"], result["corpus"]))
+        if previous is None or "error" in result or "error" in previous:
+            continue
+        ratios = [
+            "%*.2f" % (len(key), result[key] / previous[key]) if previous[key] else "-"
+            for key in keys
+        ]
+        sys.stderr.write(
+            "%-10s %-12s %s\n" % (result["codec"], result["corpus"], " ".join(ratios))
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the dataconv codecs")
+    parser.add_argument(
+        "--corpus",
+        action="append",
+        help="Corpus: %s or a file (default: all the synthetic corpora)"
+        % ", ".join(CORPORA),
+    )
+    parser.add_argument(
+        "--codec",
+        action="append",
+        choices=CODECS,
+        help="Codec to benchmark (default: all)",
+    )
+    parser.add_argument(
+        "--scale", type=int, default=1, help="Size factor of the synthetic corpora"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Number of runs (the best is kept)"
+    )
+    parser.add_argument("--output", "-o", help="Write the results to this file")
+    parser.add_argument(
+        "--compare", metavar="FILE", help="Compare with the results of a previous run"
+    )
+    args = parser.parse_args()
+
+    codecs = args.codec or list(CODECS)
+    corpora = args.corpus or list(CORPORA)
+    results = []
+    for corpus in corpora:
+        for codec in codecs:
+            result = measure(codec, corpus, args.scale, args.repeat)
+            sys.stderr.write(json.dumps(result) + "\n")
+            results.append(result)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "libraries": library_versions(codecs),
+        "scale": args.scale,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    data = json.dumps(report, indent=1) + "\n"
+    if args.output is None:
+        sys.stdout.write(data)
+    else:
+        with open(args.output, "wt") as f:
+            f.write(data)
+
+    if args.compare is not None:
+        with open(args.compare, "rt") as f:
+            compare(results, json.load(f)["results"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,543 @@
+#!/usr/bin/python3
+"""
+Convert data between JSON, YAML, MessagePack and CBOR.
+
+    dataconv.py FROM TO [FILE] [--stream] [--pretty] [--output FILE]
+
+The codec libraries are only imported when needed, so that startup stays fast
+(eg. when called for each file in a loop).
+
+In stream mode, the input is a sequence of records converted one at a time:
+JSON lines, YAML documents (separated by `---`) or concatenated MessagePack
+or CBOR objects. YAML input holding several documents is always converted
+in stream mode. JSON lines and YAML documents can be converted in parallel
+(--jobs) by splitting the input on record boundaries.
+
+With --tree SRC DEST, all the files of a directory tree are converted (on a
+process pool). A manifest of the size, modification time and hash of each
+source file is kept in DEST so that only changed files are converted on the
+next run.
+
+The json2yaml.py, yaml2json.py, json2msgpack.py, msgpack2json.py,
+json2cbor.py and cbor2json.py scripts are entry points for this module.
+"""
+
+import argparse
+import hashlib
+import importlib
+import io
+import itertools
+import json
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+
+import linestats
+
+BUFFER_SIZE = 1024 * 1024
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class Codec:
+    """Base class for codecs
+
+    `module` is the name of the library imported on first use (as `self.lib`).
+
+    Codecs implement load(input) and dump(obj, output, pretty) for whole
+    documents, load_stream(input) and dump_record(obj, output) for streams
+    of records and, when the records can be found without decoding them,
+    split(input, size) which splits a stream in chunks of about `size` bytes
+    of complete records.
+    """
+
+    name: str
+    module: str
+    # File name extensions (the first one is used for output files):
+    extensions: Tuple[str, ...]
+    # Whether a file may hold several records (converted as a stream):
+    multi_document = False
+    # None if the records cannot be split without decoding them:
+    split: Optional[Callable[[BinaryIO, int], Iterator[bytes]]]
+    _lib = None
+
+    @property
+    def lib(self):
+        if self._lib is None:
+            self._lib = importlib.import_module(self.module)
+        return self._lib
+
+
+class JsonCodec(Codec):
+    name = "json"
+    module = "json"
+    extensions = (".json",)
+
+    def load(self, input: BinaryIO) -> Any:
+        return self.lib.load(input)
+
+    def dump(self, obj: Any, output: BinaryIO, pretty: bool = False) -> None:
+        output.write(self.lib.dumps(obj, indent="  " if pretty else None).encode())
+
+    def load_stream(self, input: BinaryIO) -> Iterator[Any]:
+        loads = self.lib.loads
+        for line in input:
+            if line.strip():
+                yield loads(line)
+
+    def dump_record(self, obj: Any, output: BinaryIO) -> None:
+        output.write(self.lib.dumps(obj).encode() + b"\n")
+
+    def split(self, input: BinaryIO, size: int) -> Iterator[bytes]:
+        while True:
+            lines = input.readlines(size)
+            if not lines:
+                break
+            yield b"".join(lines)
+
+
+YAML_DOCUMENT_START = re.compile(rb"---(?:[ \t\r\n]|$)")
+
+
+class YamlCodec(Codec):
+    name = "yaml"
+    module = "yaml"
+    extensions = (".yaml", ".yml")
+    multi_document = True
+
+    @property
+    def loader(self):
+        # Use libyaml when available:
+        return getattr(self.lib, "CSafeLoader", self.lib.SafeLoader)
+
+    def load(self, input: BinaryIO) -> Any:
+        return self.lib.load(input, Loader=self.loader)
+
+    def dump(self, obj: Any, output: BinaryIO, pretty: bool = False) -> None:
+        output.write(self.lib.safe_dump(obj).encode())
+
+    def load_stream(self, input: BinaryIO) -> Iterator[Any]:
+        return self.lib.load_all(input, Loader=self.loader)
+
+    def dump_record(self, obj: Any, output: BinaryIO) -> None:
+        output.write(self.lib.safe_dump(obj, explicit_start=True).encode())
+
+    def split(self, input: BinaryIO, size: int) -> Iterator[bytes]:
+        # Document start markers are at the start of a line
+        # (possibly preceded by directives):
+        chunk: List[bytes] = []
+        length = 0
+        directives: List[bytes] = []
+        for line in input:
+            if line.startswith(b"%"):
+                directives.append(line)
+                continue
+            if length >= size and YAML_DOCUMENT_START.match(line):
+                yield b"".join(chunk)
+                chunk = []
+                length = 0
+            for item in directives + [line]:
+                chunk.append(item)
+                length += len(item)
+            directives = []
+        chunk.extend(directives)
+        if chunk:
+            yield b"".join(chunk)
+
+
+class MsgpackCodec(Codec):
+    name = "msgpack"
+    module = "msgpack"
+    extensions = (".msgpack", ".mp")
+    split = None
+
+    def load(self, input: BinaryIO) -> Any:
+        return self.lib.load(input)
+
+    def dump(self, obj: Any, output: BinaryIO, pretty: bool = False) -> None:
+        output.write(self.lib.packb(obj))
+
+    def load_stream(self, input: BinaryIO) -> Iterator[Any]:
+        return self.lib.Unpacker(input, read_size=BUFFER_SIZE)
+
+    def dump_record(self, obj: Any, output: BinaryIO) -> None:
+        output.write(self.lib.packb(obj))
+
+
+class CborCodec(Codec):
+    name = "cbor"
+    module = "cbor"
+    extensions = (".cbor",)
+    split = None
+
+    def load(self, input: BinaryIO) -> Any:
+        return self.lib.load(input)
+
+    def dump(self, obj: Any, output: BinaryIO, pretty: bool = False) -> None:
+        self.lib.dump(obj, output)
+
+    def load_stream(self, input: BinaryIO) -> Iterator[Any]:
+        # Decode one object at a time until the end of the input:
+        while input.peek(1):
+            yield self.lib.load(input)
+
+    def dump_record(self, obj: Any, output: BinaryIO) -> None:
+        output.write(self.lib.dumps(obj))
+
+
+CODECS: Dict[str, Codec] = {}
+
+
+def register(codec: Codec) -> None:
+    CODECS[codec.name] = codec
+
+
+for codec in [JsonCodec(), YamlCodec(), MsgpackCodec(), CborCodec()]:
+    register(codec)
+
+
+def open_input(filename: Optional[str]) -> BinaryIO:
+    if filename is None or filename == "-":
+        return open(sys.stdin.fileno(), "rb", buffering=BUFFER_SIZE, closefd=False)
+    return open(filename, "rb", buffering=BUFFER_SIZE)
+
+
+def open_output(filename: Optional[str]) -> BinaryIO:
+    if filename is None or filename == "-":
+        return open(sys.stdout.fileno(), "wb", buffering=BUFFER_SIZE, closefd=False)
+    return open(filename, "wb", buffering=BUFFER_SIZE)
+
+
+def convert(
+    source: Codec,
+    target: Codec,
+    input: BinaryIO,
+    output: BinaryIO,
+    stream: bool = False,
+    pretty: bool = False,
+) -> None:
+    if stream:
+        dump_record = target.dump_record
+        for obj in source.load_stream(input):
+            dump_record(obj, output)
+    elif source.multi_document:
+        # Convert a multi-document input (eg. a YAML bundle) as a stream:
+        documents = iter(source.load_stream(input))
+        first = next(documents, None)
+        second = next(documents, documents)
+        if second is documents:
+            target.dump(first, output, pretty)
+            return
+        dump_record = target.dump_record
+        for obj in itertools.chain([first, second], documents):
+            dump_record(obj, output)
+    else:
+        target.dump(source.load(input), output, pretty)
+
+
+def _convert_chunk(source: str, target: str, chunk: bytes) -> bytes:
+    output = io.BytesIO()
+    convert(CODECS[source], CODECS[target], io.BytesIO(chunk), output, stream=True)
+    return output.getvalue()
+
+
+def convert_parallel(
+    source: str,
+    target: str,
+    input: BinaryIO,
+    output: BinaryIO,
+    jobs: int,
+    chunk_size: int = CHUNK_SIZE,
+    stream: bool = True,
+    pretty: bool = False,
+) -> None:
+    """Convert a stream of records on a process pool (output in input order)
+
+    Without `stream`, an input which fits in a single chunk is converted as a
+    whole (eg. a single YAML document).
+    """
+    chunks = CODECS[source].split(input, chunk_size)
+    if not stream:
+        first = next(chunks, b"")
+        second = next(chunks, None)
+        if second is None:
+            convert(
+                CODECS[source], CODECS[target], io.BytesIO(first), output, False, pretty
+            )
+            return
+        chunks = itertools.chain([first, second], chunks)
+    with ProcessPoolExecutor(jobs, initializer=linestats.ignore_interrupt) as executor:
+        tasks = ((source, target, chunk) for chunk in chunks)
+        for data in linestats.map_ordered(executor, _convert_chunk, tasks, 2 * jobs):
+            output.write(data)
+
+
+def convert_file(
+    source: str,
+    target: str,
+    infile: Optional[str],
+    outfile: Optional[str],
+    stream: bool = False,
+    pretty: bool = False,
+    jobs: int = 1,
+) -> None:
+    with open_input(infile) as input, open_output(outfile) as output:
+        if jobs > 1:
+            convert_parallel(
+                source, target, input, output, jobs, stream=stream, pretty=pretty
+            )
+        else:
+            convert(CODECS[source], CODECS[target], input, output, stream, pretty)
+
+
+MANIFEST_NAME = ".dataconv-manifest.json"
+
+
+def file_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def write_atomically(filename: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, filename)
+
+
+def _convert_tree_file(
+    source: str,
+    target: str,
+    src: str,
+    dest: str,
+    stream: bool,
+    pretty: bool,
+    known_hash: Optional[str],
+) -> Tuple[str, bool]:
+    """Convert a file unless its content is unchanged
+
+    Returns the hash of the source file and whether it was converted.
+    """
+    with open(src, "rb") as f:
+        data = f.read()
+    digest = file_hash(data)
+    if digest == known_hash and os.path.exists(dest):
+        return digest, False
+    output = io.BytesIO()
+    input = io.BufferedReader(io.BytesIO(data))
+    convert(CODECS[source], CODECS[target], input, output, stream, pretty)
+    write_atomically(dest, output.getvalue())
+    return digest, True
+
+
+def load_manifest(filename: str, options: dict) -> Dict[str, dict]:
+    """Load the manifest entries (if they were made with the same options)"""
+    try:
+        with open(filename, "rt") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {}
+    if manifest.get("options") != options:
+        return {}
+    return manifest["files"]
+
+
+def find_tree_files(srcdir: str, extensions: Tuple[str, ...]) -> List[str]:
+    res = []
+    for dirpath, dirnames, filenames in os.walk(srcdir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith(extensions):
+                res.append(os.path.relpath(os.path.join(dirpath, filename), srcdir))
+    return res
+
+
+def convert_tree(
+    source: str,
+    target: str,
+    srcdir: str,
+    destdir: str,
+    stream: bool = False,
+    pretty: bool = False,
+    jobs: int = 1,
+) -> bool:
+    """Convert the files of a directory tree which changed since the last run
+
+    Files are skipped without reading them if their size and modification
+    time are unchanged and without converting them if their hash is
+    unchanged. The outputs of removed source files are removed (the
+    previous outputs of the files which fail to convert are kept). Source
+    files which would have the same output (eg. a.yaml and a.yml) fail.
+    Returns whether all the files could be converted.
+    """
+    manifest_filename = os.path.join(destdir, MANIFEST_NAME)
+    options = {"source": source, "target": target, "stream": stream, "pretty": pretty}
+    old_entries = load_manifest(manifest_filename, options)
+    entries = {}
+    extension = CODECS[target].extensions[0]
+    counts = {"converted": 0, "unchanged": 0, "removed": 0, "failed": 0}
+
+    relpaths = find_tree_files(srcdir, CODECS[source].extensions)
+    sources: Dict[str, List[str]] = {}
+    for relpath in relpaths:
+        output = os.path.splitext(relpath)[0] + extension
+        sources.setdefault(output, []).append(relpath)
+
+    tasks = []
+    for relpath in relpaths:
+        src = os.path.join(srcdir, relpath)
+        output = os.path.splitext(relpath)[0] + extension
+        dest = os.path.join(destdir, output)
+        if len(sources[output]) > 1:
+            # Eg. a.yaml and a.yml:
+            sys.stderr.write(
+                "%s: same output %s as %s\n"
+                % (
+                    relpath,
+                    output,
+                    ", ".join(other for other in sources[output] if other != relpath),
+                )
+            )
+            counts["failed"] += 1
+            if relpath in old_entries:
+                entries[relpath] = old_entries[relpath]
+            continue
+        st = os.stat(src)
+        entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "output": output}
+        old_entry = old_entries.get(relpath)
+        if (
+            old_entry is not None
+            and old_entry["size"] == st.st_size
+            and old_entry["mtime_ns"] == st.st_mtime_ns
+            and old_entry["output"] == output
+            and os.path.exists(dest)
+        ):
+            entries[relpath] = old_entry
+            counts["unchanged"] += 1
+            continue
+        known_hash = None
+        if old_entry is not None and old_entry["output"] == output:
+            known_hash = old_entry["hash"]
+        tasks.append(
+            (relpath, entry, (source, target, src, dest, stream, pretty, known_hash))
+        )
+
+    with ProcessPoolExecutor(
+        max(jobs, 1), initializer=linestats.ignore_interrupt
+    ) as executor:
+        futures = {
+            executor.submit(_convert_tree_file, *task_args): (relpath, entry)
+            for relpath, entry, task_args in tasks
+        }
+        for future in as_completed(futures):
+            relpath, entry = futures[future]
+            try:
+                digest, converted = future.result()
+            except Exception as e:
+                sys.stderr.write("%s: %s\n" % (relpath, e))
+                counts["failed"] += 1
+                # Keep the previous output (the file is retried on the next run):
+                if relpath in old_entries:
+                    entries[relpath] = old_entries[relpath]
+                continue
+            entry["hash"] = digest
+            entries[relpath] = entry
+            counts["converted" if converted else "unchanged"] += 1
+
+    # Remove the outputs of the source files which no longer exist:
+    outputs = {entry["output"] for entry in entries.values()}
+    for relpath, old_entry in old_entries.items():
+        if relpath not in entries and old_entry["output"] not in outputs:
+            try:
+                os.unlink(os.path.join(destdir, old_entry["output"]))
+            except FileNotFoundError:
+                pass
+            counts["removed"] += 1
+
+    manifest = {"options": options, "files": dict(sorted(entries.items()))}
+    write_atomically(manifest_filename, json.dumps(manifest, indent=1).encode())
+    sys.stderr.write(
+        ", ".join("%i %s" % (count, name) for name, count in counts.items()) + "\n"
+    )
+    return counts["failed"] == 0
+
+
+def main(
+    source: Optional[str] = None,
+    target: Optional[str] = None,
+    argv: Optional[List[str]] = None,
+) -> None:
+    """Command line entry point
+
+    When `source` and `target` are given (entry point scripts such as
+    json2yaml.py), they are not expected on the command line.
+    """
+    if source is None:
+        description = "Convert data between formats"
+    else:
+        description = "Convert %s to %s" % (source, target)
+    parser = argparse.ArgumentParser(description=description)
+    if source is None:
+        parser.add_argument("source", metavar="FROM", choices=CODECS)
+        parser.add_argument("target", metavar="TO", choices=CODECS)
+    parser.add_argument("filename", metavar="FILE", nargs="?", help="Input file")
+    parser.add_argument("--output", "-o", help="Output file")
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        default=False,
+        help="Convert a sequence of records (JSON lines, YAML documents,"
+        + " concatenated MessagePack or CBOR objects)",
+    )
+    parser.add_argument(
+        "--pretty", action="store_true", default=False, help="Pretty print"
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of worker processes (with --tree, YAML input or --stream"
+        + " and JSON lines input)",
+    )
+    parser.add_argument(
+        "--tree",
+        nargs=2,
+        metavar=("SRC", "DEST"),
+        help="Convert the files of the SRC directory tree into DEST"
+        + " (only the files which changed since the last run)",
+    )
+    args = parser.parse_intermixed_args(argv)
+    if source is None:
+        source, target = args.source, args.target
+
+    if args.tree is not None:
+        if args.filename is not None or args.output is not None:
+            parser.error("--tree cannot be used with FILE or --output")
+        srcdir, destdir = args.tree
+        if not convert_tree(
+            source, target, srcdir, destdir, args.stream, args.pretty, args.jobs
+        ):
+            sys.exit(1)
+        return
+
+    codec = CODECS[source]
+    if args.jobs > 1 and not (
+        (args.stream or codec.multi_document) and codec.split is not None
+    ):
+        parser.error("--jobs requires YAML input or --stream and JSON lines input")
+
+    convert_file(
+        source,
+        target,
+        args.filename,
+        args.output,
+        args.stream,
+        args.pretty,
+        args.jobs,
+    )
+
+
+if __name__ == "__main__":
+    main()
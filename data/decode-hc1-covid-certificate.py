@@ -1,4 +1,14 @@
+import argparse
+import base64
+import json
+import os
 import sys
+import zlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from linestats import map_ordered
 
 # https://gitlab.inria.fr/tousanticovid-verif/tousanticovid-verif-android
 
@@ -7,27 +17,38 @@ digit2num = {digit: i for i, digit in enumerate(digits)}
 assert len(digits) == 45
 
 # Base 45 decoding: https://datatracker.ietf.org/doc/draft-faltstrom-base45/
-def decode_base45(data: str) -> bytes:
+#
+# The digits are mapped to their values with a translation table and
+# the triplets are combined (and packed as big-endian 16-bit integers)
+# using array operations instead of one bytes object per chunk.
+INVALID_DIGIT = 0xFF
+BASE45_TABLE = bytes(digit2num.get(chr(i), INVALID_DIGIT) for i in range(256))
+
 
-    ochunks = []
-    for i in range(0, len(data), 3):
-        chunk = data[i : i + 3]
-        if len(chunk) == 2:
-            c = digit2num[chunk[0]]
-            d = digit2num[chunk[1]]
-            n = c + d * 45
-            ochunk = bytes([n])
-        elif len(chunk) == 3:
-            c = digit2num[chunk[0]]
-            d = digit2num[chunk[1]]
-            e = digit2num[chunk[2]]
-            n = c + d * 45 + e * 45 * 45
-            ochunk = bytes([n // 256, n % 256])
-        else:
-            raise Exception("invalid length")
-        ochunks.append(ochunk)
-
-    res = b"".join(ochunks)
+def decode_base45(data: str) -> bytes:
+    values = data.encode("ascii", "replace").translate(BASE45_TABLE)
+    if INVALID_DIGIT in values:
+        raise Exception("invalid digit")
+    length = len(values) - len(values) % 3
+    if len(values) - length == 1:
+        raise Exception("invalid length")
+
+    numbers = [
+        c + d * 45 + e * 45 * 45
+        for c, d, e in zip(values[0:length:3], values[1:length:3], values[2:length:3])
+    ]
+    if numbers and max(numbers) > 0xFFFF:
+        raise Exception("invalid chunk")
+    numbers = array("H", numbers)
+    if sys.byteorder == "little":
+        numbers.byteswap()
+    res = numbers.tobytes()
+
+    if length != len(values):
+        n = values[length] + values[length + 1] * 45
+        if n > 0xFF:
+            raise Exception("invalid chunk")
+        res += bytes([n])
     return res
 
 
@@ -36,55 +57,163 @@ assert decode_base45("%69 VD92EX0") == b"Hello!!"
 assert decode_base45("UJCLQE7W581") == b"base-45"
 assert decode_base45("QED8WEX0") == b"ietf!"
 
-data = sys.argv[1]
-print(data)
-
 expected_prefix = "HC1:"
-if not data.startswith(expected_prefix):
-    raise Exception("Invalid prefix")
-data = data[len(expected_prefix) :]
-
-decoded = decode_base45(data)
-print("Decoded=")
-print(decoded)
-print("")
-
-import zlib
 
-decompressed = zlib.decompress(decoded)
-print("Decompressed=")
-print(decompressed)
-print("")
-
-import cbor
-
-cose = cbor.loads(decompressed)
-print("COSE=")
-print(cose)
-print("")
-
-# See https://www.iana.org/assignments/cbor-tags/cbor-tags.xhtml
-# Tag 18 = COSE_Sign1 (COSE Single Signer Data Object) [RFC-ietf-cose-rfc8152bis-struct-15]
-# COSE_Untagged_Message = COSE_Sign / COSE_Sign1 / COSE_Encrypt / COSE_Encrypt0 / COSE_Mac / COSE_Mac0
-
-assert cose.tag == 18
-protected, unprotected, payload, signature = cose.value
-
-print("Protected=")
-print(cbor.loads(protected))
-print("")
-
-print("Unprotected=")
-print(unprotected)
-print("")
-
-# See https://www.iana.org/assignments/cwt/cwt.xhtml:
-print(cbor.loads(payload))
-
-cbor_payload = cbor.loads(payload)
-
-import json
+# Number of certificates per task in batch mode:
+BATCH_SIZE = 256
 
-print(json.dumps(cbor_payload[-260], indent=2))
 
-# breakpoint()
+def print_certificate(data: str) -> None:
+    print(data)
+
+    if not data.startswith(expected_prefix):
+        raise Exception("Invalid prefix")
+    data = data[len(expected_prefix) :]
+
+    decoded = decode_base45(data)
+    print("Decoded=")
+    print(decoded)
+    print("")
+
+    decompressed = zlib.decompress(decoded)
+    print("Decompressed=")
+    print(decompressed)
+    print("")
+
+    import cbor
+
+    cose = cbor.loads(decompressed)
+    print("COSE=")
+    print(cose)
+    print("")
+
+    # See https://www.iana.org/assignments/cbor-tags/cbor-tags.xhtml
+    # Tag 18 = COSE_Sign1 (COSE Single Signer Data Object) [RFC-ietf-cose-rfc8152bis-struct-15]
+    # COSE_Untagged_Message = COSE_Sign / COSE_Sign1 / COSE_Encrypt / COSE_Encrypt0 / COSE_Mac / COSE_Mac0
+
+    assert cose.tag == 18
+    protected, unprotected, payload, signature = cose.value
+
+    print("Protected=")
+    print(cbor.loads(protected))
+    print("")
+
+    print("Unprotected=")
+    print(unprotected)
+    print("")
+
+    # See https://www.iana.org/assignments/cwt/cwt.xhtml:
+    print(cbor.loads(payload))
+
+    cbor_payload = cbor.loads(payload)
+
+    print(json.dumps(cbor_payload[-260], indent=2))
+
+
+def to_json(obj):
+    """Convert decoded CBOR into JSON-compatible values"""
+    if isinstance(obj, dict):
+        return {str(key): to_json(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_json(value) for value in obj]
+    if isinstance(obj, bytes):
+        return base64.b64encode(obj).decode()
+    if hasattr(obj, "tag") and hasattr(obj, "value"):
+        return {"tag": obj.tag, "value": to_json(obj.value)}
+    return obj
+
+
+def decode_payload(decoded: bytes) -> dict:
+    """Decompress and decode a COSE_Sign1 certificate (zlib and CBOR stages)"""
+    import cbor
+
+    cose = cbor.loads(zlib.decompress(decoded))
+    if getattr(cose, "tag", None) != 18:
+        raise Exception("Not a COSE_Sign1 object")
+    protected, unprotected, payload, signature = cose.value
+    return {
+        "protected": to_json(cbor.loads(protected) if protected else {}),
+        "unprotected": to_json(unprotected),
+        "payload": to_json(cbor.loads(payload)),
+        "signature": to_json(signature),
+    }
+
+
+def _decode_record(item):
+    filename, line, decoded = item
+    record = {"file": filename, "line": line}
+    if isinstance(decoded, str):
+        record["error"] = decoded
+        return record
+    try:
+        record.update(decode_payload(decoded))
+    except ImportError:
+        raise
+    except Exception as e:
+        record["error"] = str(e)
+    return record
+
+
+def _decode_batch(items):
+    return [json.dumps(_decode_record(item)) + "\n" for item in items]
+
+
+def read_file_certificates(filename, file):
+    """Decode the base45 of the certificates (one per line)"""
+    for line, data in enumerate(file, 1):
+        data = data.strip()
+        if not data:
+            continue
+        try:
+            if not data.startswith(expected_prefix):
+                raise Exception("Invalid prefix")
+            yield filename, line, decode_base45(data[len(expected_prefix) :])
+        except Exception as e:
+            yield filename, line, str(e)
+
+
+def read_certificates(filenames):
+    if not filenames:
+        yield from read_file_certificates("-", sys.stdin)
+        return
+    for filename in filenames:
+        with open(filename, "rt") as file:
+            yield from read_file_certificates(filename, file)
+
+
+def batch(filenames, jobs):
+    """Decode many certificates into JSON lines (in input order)"""
+    jobs = jobs or os.cpu_count() or 1
+    items = read_certificates(filenames)
+    batches = iter(lambda: list(islice(items, BATCH_SIZE)), [])
+    output = sys.stdout
+    with ProcessPoolExecutor(jobs) as executor:
+        tasks = ((chunk,) for chunk in batches)
+        for lines in map_ordered(executor, _decode_batch, tasks, 2 * jobs):
+            output.writelines(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode HC1 COVID certificates")
+    parser.add_argument("certificate", nargs="?", help="HC1 certificate (HC1:...)")
+    parser.add_argument(
+        "--batch",
+        nargs="*",
+        metavar="FILE",
+        help="Decode the certificates (one per line) of the files"
+        + " (or of the standard input) into JSON lines",
+    )
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=None, help="Number of worker processes"
+    )
+    args = parser.parse_args()
+    if args.batch is not None:
+        batch(args.batch, args.jobs)
+    elif args.certificate is not None:
+        print_certificate(args.certificate)
+    else:
+        parser.error("a certificate or --batch is required")
+
+
+if __name__ == "__main__":
+    main()
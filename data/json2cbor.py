@@ -1,8 +1,8 @@
 #!/usr/bin/python3
+#
+# Convert JSON to CBOR (see dataconv.py)
 
-import sys
-import json
-import cbor
+from dataconv import main
 
-obj =  json.load(sys.stdin)
-cbor.dump(obj, sys.stdout.buffer)
+if __name__ == "__main__":
+    main("json", "cbor")
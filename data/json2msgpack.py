@@ -1,7 +1,8 @@
 #!/usr/bin/python3
-import msgpack
-import json
-from sys import stdin, stdout
+#
+# Convert JSON to MessagePack (see dataconv.py)
 
-data = json.load(stdin)
-stdout.buffer.write(msgpack.packb(data))
+from dataconv import main
+
+if __name__ == "__main__":
+    main("json", "msgpack")
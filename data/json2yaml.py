@@ -1,13 +1,8 @@
 #!/usr/bin/python3
+#
+# Convert JSON to YAML (see dataconv.py)
 
-import sys
-import json
-import yaml
+from dataconv import main
 
-if len(sys.argv) < 2:
-    data = json.load(sys.stdin)
-else:
-    with open(sys.argv[1], "rt") as f:
-        data = json.load(f)
-
-sys.stdout.write(yaml.dump(data))
+if __name__ == "__main__":
+    main("json", "yaml")
@@ -0,0 +1,218 @@
+"""
+Throughput and rejection statistics for the *2jsonl line converters.
+
+Counts lines read, matched and rejected (by reason), bytes read and written
+and time spent in each stage (parse, convert, serialize). Statistics are
+written as JSON lines to stderr (or to a file), periodically and/or at the
+end of the run.
+
+Also the helpers shared by the converters for processing their input in
+parallel: reading blocks of complete lines, splitting files in chunks of
+complete lines and running tasks on a process pool with ordered results.
+"""
+
+import json
+import os
+import signal
+import sys
+import time
+from collections import deque
+from concurrent.futures import Executor
+from typing import Callable, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+STAGES = ("parse", "convert", "serialize")
+
+# Check the report interval every N lines:
+TICK_LINES = 4096
+
+timer = time.perf_counter
+
+
+class Stats:
+    lines_read: int
+    lines_matched: int
+    rejected: dict
+    bytes_in: int
+    bytes_out: int
+    times: dict
+
+    def __init__(
+        self, output: Optional[TextIO] = None, interval: Optional[float] = None
+    ) -> None:
+        self._output = output
+        self._interval = interval
+        self._start = time.monotonic()
+        self._last_report = self._start
+        self._countdown = TICK_LINES
+        self.rejected = {}
+        self.times = {}
+        self.reset()
+
+    def reset(self) -> None:
+        self.lines_read = 0
+        self.lines_matched = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Updated in place, the dictionaries may be referenced by hot loops:
+        self.rejected.clear()
+        self.times.clear()
+        self.times.update((stage, 0.0) for stage in STAGES)
+
+    def reject(self, reason: str) -> None:
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+
+    def to_dict(self) -> dict:
+        return {
+            "lines_read": self.lines_read,
+            "lines_matched": self.lines_matched,
+            "lines_rejected": dict(self.rejected),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "time": dict(self.times),
+        }
+
+    def pop(self) -> dict:
+        """Return the counters and reset them (eg. in worker processes)"""
+        res = self.to_dict()
+        self.reset()
+        return res
+
+    def merge(self, counters: dict) -> None:
+        self.lines_read += counters["lines_read"]
+        self.lines_matched += counters["lines_matched"]
+        for reason, count in counters["lines_rejected"].items():
+            self.rejected[reason] = self.rejected.get(reason, 0) + count
+        self.bytes_in += counters["bytes_in"]
+        self.bytes_out += counters["bytes_out"]
+        for stage, duration in counters["time"].items():
+            self.times[stage] = self.times.get(stage, 0.0) + duration
+
+    def tick(self) -> None:
+        """Call maybe_report() every TICK_LINES calls (cheap enough per line)"""
+        self._countdown -= 1
+        if self._countdown == 0:
+            self._countdown = TICK_LINES
+            self.maybe_report()
+
+    def maybe_report(self) -> None:
+        """Report if the report interval has elapsed"""
+        if (
+            self._interval is not None
+            and time.monotonic() - self._last_report >= self._interval
+        ):
+            self.report()
+
+    def report(self, final: bool = False) -> None:
+        if self._output is None:
+            return
+        now = time.monotonic()
+        elapsed = now - self._start
+        data = self.to_dict()
+        data["elapsed"] = elapsed
+        if elapsed > 0:
+            data["lines_per_second"] = self.lines_read / elapsed
+            data["bytes_in_per_second"] = self.bytes_in / elapsed
+        data["final"] = final
+        self._output.write(json.dumps(data) + "\n")
+        self._output.flush()
+        self._last_report = now
+
+
+def add_arguments(parser) -> None:
+    """Add the statistics options to an ArgumentParser"""
+    parser.add_argument(
+        "--stats",
+        default=False,
+        action="store_true",
+        help="Report statistics (as JSON) at the end of the run",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        help="Report statistics every given number of seconds",
+    )
+    parser.add_argument(
+        "--stats-file",
+        help="Append statistics to this file instead of stderr",
+    )
+
+
+def enabled(args) -> bool:
+    return args.stats or args.stats_interval is not None or args.stats_file is not None
+
+
+def from_options(
+    stats: bool, interval: Optional[float], filename: Optional[str]
+) -> Optional[Stats]:
+    if not stats and interval is None and filename is None:
+        return None
+    output = sys.stderr if filename is None else open(filename, "at")
+    return Stats(output, interval)
+
+
+def from_args(args) -> Optional[Stats]:
+    return from_options(args.stats, args.stats_interval, args.stats_file)
+
+
+BLOCK_SIZE = 1024 * 1024
+
+
+def read_blocks(
+    read: Callable[[int], bytes], size: int = BLOCK_SIZE
+) -> Iterator[bytes]:
+    """Read blocks of complete lines (the last line may lack its newline)"""
+    rest = b""
+    while True:
+        data = read(size)
+        if not data:
+            break
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            rest += data
+            continue
+        yield rest + data[:end]
+        rest = data[end:]
+    if rest:
+        yield rest
+
+
+def split_chunks(
+    filename: str, chunk_size: int, start: int = 0, end: Optional[int] = None
+) -> List[Tuple[int, int]]:
+    """Split a file (or a range of a file) in (start, end) chunks of complete lines"""
+    if end is None:
+        end = os.path.getsize(filename)
+    chunks = []
+    with open(filename, "rb") as f:
+        while start < end:
+            if start + chunk_size >= end:
+                chunk_end = end
+            else:
+                f.seek(start + chunk_size - 1)
+                f.readline()
+                chunk_end = f.tell()
+            chunks.append((start, chunk_end))
+            start = chunk_end
+    return chunks
+
+
+def ignore_interrupt() -> None:
+    """Process pool initializer letting the main process handle interruption"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def map_ordered(
+    executor: Executor, fn: Callable, tasks: Iterable[tuple], window: int
+) -> Iterator:
+    """Yield fn(*args) for each tuple of arguments, computed on an executor
+
+    The results are yielded in order. At most `window` tasks are in flight at
+    any given time in order to bound memory usage.
+    """
+    pending: deque = deque()
+    for args in tasks:
+        pending.append(executor.submit(fn, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
@@ -1,26 +1,181 @@
 #!/usr/bin/python3
 
-import click
+import os
+import signal
+import sys
+from concurrent.futures import ProcessPoolExecutor
 from json import dumps
 
+import click
+
+import linestats
+from linestats import map_ordered, read_blocks, split_chunks, timer
+
+ENCODING = 'utf-8'
+DECODE_ERRORS = 'backslashreplace'
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+class Converter:
+    """
+    Convert blocks of LTSV lines into JSON lines
+
+    Labels are decoded once and interned. With `fields`, only the values
+    of the selected labels are decoded and they are output in this order.
+    Tokens without a colon are ignored and empty lines are skipped.
+
+    Lines end with "\n", "\r\n" or "\r" (universal newlines, as when the
+    input was read in text mode): carriage returns are not part of the values.
+    """
+
+    def __init__(self, fields=None, stats=None):
+        self.fields = fields
+        self.stats = stats
+        self._keys = {}
+        if fields is not None:
+            self._keys = {field.encode(ENCODING): sys.intern(field) for field in fields}
+
+    def _key(self, label):
+        key = sys.intern(label.decode(ENCODING, DECODE_ERRORS))
+        self._keys[label] = key
+        return key
+
+    def parse(self, line):
+        keys = self._keys
+        data = {}
+        if self.fields is None:
+            for token in line.split(b'\t'):
+                label, sep, value = token.partition(b':')
+                if not sep:
+                    continue
+                key = keys.get(label)
+                if key is None:
+                    key = self._key(label)
+                data[key] = value.decode(ENCODING, DECODE_ERRORS)
+            return data
+        for token in line.split(b'\t'):
+            label, sep, value = token.partition(b':')
+            key = keys.get(label)
+            if key is not None and sep:
+                data[key] = value.decode(ENCODING, DECODE_ERRORS)
+        return {field: data[field] for field in self.fields if field in data}
+
+    def convert(self, block):
+        """Convert a block of complete lines, returns the encoded output"""
+        # Universal newlines:
+        lines = block.replace(b'\r\n', b'\n').replace(b'\r', b'\n').split(b'\n')
+        if lines[-1] == b'':
+            lines.pop()
+        parse = self.parse
+        stats = self.stats
+        if stats is None:
+            output = [dumps(parse(line)) for line in lines if line]
+        else:
+            output = []
+            times = stats.times
+            stats.lines_read += len(lines)
+            stats.bytes_in += len(block)
+            for line in lines:
+                if not line:
+                    stats.reject('empty')
+                    continue
+                start = timer()
+                data = parse(line)
+                parsed = timer()
+                times['parse'] += parsed - start
+                stats.lines_matched += 1
+                output.append(dumps(data))
+                times['serialize'] += timer() - parsed
+        if not output:
+            return b''
+        res = ('\n'.join(output) + '\n').encode(ENCODING)
+        if stats is not None:
+            stats.bytes_out += len(res)
+        return res
+
+
+_worker_converter = None
+
+
+def _init_worker(fields, stats):
+    global _worker_converter
+    _worker_converter = Converter(fields, linestats.Stats() if stats else None)
+    linestats.ignore_interrupt()
+
+
+def _convert_chunk(filename, start, end):
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    stats = _worker_converter.stats
+    output = _worker_converter.convert(data)
+    return output, None if stats is None else stats.pop()
+
+
+def write_blocks(converter, read, output):
+    stats = converter.stats
+    for block in read_blocks(read):
+        output.write(converter.convert(block))
+        if stats is not None:
+            stats.maybe_report()
+
+
+def write_chunks(executor, chunks, window, output, stats):
+    for data, counters in map_ordered(executor, _convert_chunk, chunks, window):
+        output.write(data)
+        if counters is not None:
+            stats.merge(counters)
+            stats.maybe_report()
+
 
 @click.command()
-@click.argument('input', type=click.File('rt'), default="-")
-def main(input):
+@click.argument('inputs', nargs=-1, type=click.Path(allow_dash=True))
+@click.option('--fields', multiple=True, help="Comma-separated list of the labels to output (in this order)")
+@click.option('--jobs', '-j', type=int, default=1, help="Number of worker processes for converting regular files")
+@click.option('--stats', is_flag=True, help="Report statistics (as JSON) at the end of the run")
+@click.option('--stats-interval', type=float, help="Report statistics every given number of seconds")
+@click.option('--stats-file', help="Append statistics to this file instead of stderr")
+def main(inputs, fields, jobs, stats, stats_interval, stats_file):
     """
     Convert input LTSV (Labeled Tab-separated Values) into JSON lines
     """
-    for line in input:
-        line = line.rstrip('\n')
-        data = {}
-        for token in line.split("\t"):
-            i = token.index(":")
-            if i == -1:
+    inputs = inputs or ('-',)
+    if fields:
+        fields = [name for value in fields for name in value.split(',') if name]
+    else:
+        fields = None
+    stats = linestats.from_options(stats, stats_interval, stats_file)
+    converter = Converter(fields, stats)
+    output = sys.stdout.buffer
+
+    # Correctly die on broken pipe:
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+    executor = None
+    if jobs > 1:
+        executor = ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(fields, stats is not None))
+
+    try:
+        pending = []
+        for input in inputs:
+            if executor is not None and input != '-' and os.path.isfile(input):
+                pending.extend((input, start, end) for start, end in split_chunks(input, CHUNK_SIZE))
                 continue
-            key = token[:i]
-            value = token[i+1:]
-            data[key] = value
-        print(dumps(data))
+            # Keep the output in input order:
+            write_chunks(executor, pending, 2 * jobs, output, stats)
+            pending = []
+            if input == '-':
+                write_blocks(converter, sys.stdin.buffer.read1, output)
+            else:
+                with open(input, 'rb') as f:
+                    write_blocks(converter, f.read, output)
+        write_chunks(executor, pending, 2 * jobs, output, stats)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    output.flush()
+    if stats is not None:
+        stats.report(final=True)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,8 @@
 #!/usr/bin/python3
-import msgpack
-import json
-from sys import stdin, stdout
+#
+# Convert MessagePack to JSON (see dataconv.py)
 
-data = msgpack.load(stdin.buffer)
-stdout.write(json.dumps(data))
+from dataconv import main
+
+if __name__ == "__main__":
+    main("msgpack", "json")
@@ -7,19 +7,440 @@
 #   echo "GET / HTTP/1.1" | ./re2json '^(?P<method>[^ ]*) (?P<path>[^ ]*) (?P<protocol>.*)'$
 # Output:
 #   {"method": "GET", "path": "/", "protocol": "HTTP/1.1"}
+#
+# The first pattern which matches (from the start of the line) is used.
+# Captures are strings unless a type is given with --type or --schema.
+# Consecutive patterns are combined in a single alternation so that each line
+# is scanned once and the literal prefixes of the patterns are used to skip
+# the patterns which cannot match.
 
 import json
-from sys import argv, stdin, stdout
-from re import compile
+import re
+import signal
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from ipaddress import ip_address
+from sys import stdin, stdout
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import linestats
+from linestats import map_ordered, read_blocks, timer
 
+NAMED_GROUP = re.compile(r"(?<!\\)\(\?P<(\w+)>")
+BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+GLOBAL_FLAGS = re.compile(r"\(\?([aiLmsux]+)\)")
+SPECIAL_CHARS = set(".^$*+?{}[]\\|()")
 
-patterns = [compile(arg) for arg in argv[1:]]
+ENCODING = "utf-8"
+DECODE_ERRORS = "backslashreplace"
 
-for entry in stdin:
-    entry = entry.rstrip("\n")
-    for pattern in patterns:
-        m = pattern.match(entry)
-        if m:
-            stdout.write(json.dumps(m.groupdict()) + "\n")
+
+def literal_prefix(pattern: str) -> str:
+    """Literal text which must be found at the start of the matched lines"""
+    if pattern.startswith("^"):
+        pattern = pattern[1:]
+    elif pattern.startswith("\\A"):
+        pattern = pattern[2:]
+    prefix = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\" and i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+            char = pattern[i + 1]
+            i += 2
+        elif char in SPECIAL_CHARS:
+            break
+        else:
+            i += 1
+        if i < len(pattern) and pattern[i] in "*?{":
+            # The last character is optional or repeated:
             break
+        prefix.append(char)
+    if has_top_level_alternation(pattern):
+        return ""
+    return "".join(prefix)
+
+
+def has_top_level_alternation(pattern: str) -> bool:
+    depth = 0
+    in_class = False
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\":
+            i += 2
+            continue
+        if in_class:
+            if char == "]":
+                in_class = False
+        elif char == "[":
+            in_class = True
+            if pattern[i + 1 : i + 2] == "]" or pattern[i + 1 : i + 3] == "^]":
+                i += pattern[i + 1 : i + 3].index("]") + 1
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            return True
+        i += 1
+    return False
+
+
+def combinable(pattern: str) -> Optional[str]:
+    """Return a version of the pattern suitable for inclusion in an alternation
+
+    Returns None if the pattern uses backreferences (which would be broken by
+    the renaming and renumbering of the groups).
+    """
+    if BACKREFERENCE.search(pattern):
+        return None
+    # Global flags must be at the start of the regex, use scoped flags instead:
+    match = GLOBAL_FLAGS.match(pattern)
+    if match:
+        flags = match.group(1)
+        # In verbose mode, the pattern may end with a comment:
+        end = "\n)" if "x" in flags else ")"
+        pattern = "(?" + flags + ":" + pattern[match.end() :] + end
+    if GLOBAL_FLAGS.search(pattern):
+        return None
+    return pattern
+
+
+class Alternation:
+    """Several patterns compiled in a single regex"""
+
+    def __init__(self, indices: List[int], patterns: List[str]) -> None:
+        self.indices = indices
+        self._names: Dict[str, tuple] = {}
+        parts = []
+        for i in indices:
+            prefix = "_p%i_" % i
+            names = []
+
+            def rename(match):
+                names.append((prefix + match.group(1), match.group(1)))
+                return "(?P<" + prefix + match.group(1) + ">"
+
+            part = NAMED_GROUP.sub(rename, combinable(patterns[i]))
+            self._names["_p%i" % i] = (i, names)
+            parts.append("(?P<_p%i>%s)" % (i, part))
+        self._regex = re.compile("|".join(parts))
+        # Indexed by the number of the outer group of each pattern:
+        groupindex = self._regex.groupindex
+        self._alternatives = [None] * (self._regex.groups + 1)
+        for marker, (i, names) in self._names.items():
+            self._alternatives[groupindex[marker]] = (
+                i,
+                tuple(name for group, name in names),
+                tuple(groupindex[group] for group, name in names),
+            )
+
+    def match(self, line: str) -> Optional[Tuple[int, dict]]:
+        m = self._regex.match(line)
+        if m is None:
+            return None
+        i, names, groups = self._alternatives[m.lastindex]
+        # Always a tuple (even with a single group):
+        return i, dict(zip(names, m.group(0, *groups)[1:]))
+
+
+class Single:
+    """A pattern used on its own"""
+
+    def __init__(self, index: int, pattern: str) -> None:
+        self.indices = [index]
+        self._regex = re.compile(pattern)
+
+    def match(self, line: str) -> Optional[Tuple[int, dict]]:
+        m = self._regex.match(line)
+        if m is None:
+            return None
+        return self.indices[0], m.groupdict()
+
+
+class PatternSet:
+    """Find the first matching pattern
+
+    The lines are dispatched on their first character: only the patterns
+    whose literal prefix is compatible with it are tried. The remaining
+    patterns are combined in alternations (when possible).
+    """
+
+    def __init__(self, patterns: List[str]) -> None:
+        for pattern in patterns:
+            re.compile(pattern)
+        self.patterns = patterns
+        self.hits = [0] * len(patterns)
+        self.order = list(range(len(patterns)))
+        self._prefixes = [literal_prefix(pattern) for pattern in patterns]
+        self._build()
+
+    def _alternation(self, indices: List[int]):
+        if len(indices) == 1:
+            return Single(indices[0], self.patterns[indices[0]])
+        return Alternation(indices, self.patterns)
+
+    def _matchers(self, indices: List[int]) -> list:
+        res = []
+        group: List[int] = []
+        for i in indices:
+            if combinable(self.patterns[i]) is not None:
+                group.append(i)
+                continue
+            if group:
+                res.append(self._alternation(group))
+                group = []
+            res.append(Single(i, self.patterns[i]))
+        if group:
+            res.append(self._alternation(group))
+        return res
+
+    def _build(self) -> None:
+        self._dispatch = {}
+        first_chars = {prefix[0] for prefix in self._prefixes if prefix}
+        for char in first_chars:
+            self._dispatch[char] = self._matchers(
+                [i for i in self.order if self._prefixes[i][:1] in ("", char)]
+            )
+        self._default = self._matchers(
+            [i for i in self.order if self._prefixes[i] == ""]
+        )
+
+    def match(self, line: str) -> Optional[dict]:
+        for matcher in self._dispatch.get(line[:1], self._default):
+            res = matcher.match(line)
+            if res is not None:
+                i, data = res
+                self.hits[i] += 1
+                return data
+        return None
+
+    def reorder(self) -> None:
+        """Try the most frequently matched patterns first"""
+        order = sorted(self.order, key=lambda i: -self.hits[i])
+        if order != self.order:
+            self.order = order
+            self._build()
+
+
+def parse_epoch(value: str) -> str:
+    return datetime.fromtimestamp(float(value), timezone.utc).isoformat()
+
+
+def parse_epoch_ms(value: str) -> str:
+    return datetime.fromtimestamp(float(value) / 1000, timezone.utc).isoformat()
+
+
+def parse_ip(value: str) -> str:
+    return str(ip_address(value))
+
+
+TYPES: Dict[str, Callable[[str], Any]] = {
+    "str": str,
+    "int": int,
+    "float": float,
+    "epoch": parse_epoch,
+    "epoch_ms": parse_epoch_ms,
+    "ip": parse_ip,
+}
+
+
+def make_converter(kind: str) -> Callable[[Optional[str]], Any]:
+    """Converter for a typed field ("-" and missing captures are null)"""
+    base = TYPES[kind]
+
+    def convert(value: Optional[str]) -> Any:
+        if value is None or value == "-":
+            return None
+        return base(value)
+
+    return convert
+
+
+def load_schema(args) -> Dict[str, str]:
+    schema = {}
+    if args.schema is not None:
+        with open(args.schema, "rt") as f:
+            schema.update(json.load(f))
+    for item in args.type or []:
+        name, sep, kind = item.partition("=")
+        if not sep:
+            raise ValueError("Invalid type (expected NAME=TYPE): " + item)
+        schema[name] = kind
+    for name, kind in schema.items():
+        if kind not in TYPES:
+            raise ValueError("Unknown type for %s: %s" % (name, kind))
+    return schema
+
+
+def make_record_converter(schema: Dict[str, str]) -> Optional[Callable[[dict], None]]:
+    """Convert (in place) the typed fields of a record
+
+    Raises ValueError for invalid values.
+    """
+    if not schema:
+        return None
+    converters = [(name, make_converter(kind)) for name, kind in schema.items()]
+
+    def convert(data: dict) -> None:
+        for name, converter in converters:
+            if name in data:
+                data[name] = converter(data[name])
+
+    return convert
+
+
+def process_block(
+    block: bytes,
+    patterns: PatternSet,
+    convert: Optional[Callable[[dict], None]],
+    stats: Optional[linestats.Stats] = None,
+) -> str:
+    """Convert a block of lines into JSON lines"""
+    lines = block.decode(ENCODING, DECODE_ERRORS).split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    match = patterns.match
+    dumps = json.dumps
+    output = []
+
+    if stats is None:
+        for line in lines:
+            data = match(line)
+            if data is None:
+                continue
+            if convert is not None:
+                try:
+                    convert(data)
+                except (ValueError, OverflowError):
+                    continue
+            output.append(dumps(data))
+    else:
+        stats.lines_read += len(lines)
+        stats.bytes_in += len(block)
+        times = stats.times
+        for line in lines:
+            start = timer()
+            data = match(line)
+            matched = timer()
+            times["parse"] += matched - start
+            if data is None:
+                stats.reject("no_match")
+                continue
+            if convert is not None:
+                try:
+                    convert(data)
+                except (ValueError, OverflowError):
+                    stats.reject("invalid_value")
+                    continue
+                converted = timer()
+                times["convert"] += converted - matched
+                matched = converted
+            stats.lines_matched += 1
+            output.append(dumps(data))
+            times["serialize"] += timer() - matched
+
+    if not output:
+        return ""
+    res = "\n".join(output) + "\n"
+    if stats is not None:
+        stats.bytes_out += len(res)
+    return res
+
+
+_worker_patterns = None
+_worker_convert = None
+_worker_adaptive = False
+_worker_stats = None
+
+
+def _init_worker(args) -> None:
+    global _worker_patterns, _worker_convert, _worker_adaptive, _worker_stats
+    _worker_patterns = PatternSet(args.patterns)
+    _worker_convert = make_record_converter(load_schema(args))
+    _worker_adaptive = args.adaptive
+    if linestats.enabled(args):
+        _worker_stats = linestats.Stats()
+    linestats.ignore_interrupt()
+
+
+def _process_block(block: bytes) -> Tuple[str, Optional[dict]]:
+    output = process_block(block, _worker_patterns, _worker_convert, _worker_stats)
+    if _worker_adaptive:
+        _worker_patterns.reorder()
+    return output, None if _worker_stats is None else _worker_stats.pop()
+
+
+def main():
+    parser = ArgumentParser(
+        description="Convert lines into JSON using named captures of regular expressions"
+    )
+    parser.add_argument(
+        "patterns", nargs="*", metavar="PATTERN", help="Regular expression"
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        default=False,
+        help="Reorder the patterns by number of matches after each block of input"
+        + " (only when a line cannot be matched by several patterns)",
+    )
+    parser.add_argument(
+        "--type",
+        "-t",
+        action="append",
+        metavar="NAME=TYPE",
+        help="Type of a named capture (%s)" % ", ".join(TYPES),
+    )
+    parser.add_argument(
+        "--schema",
+        help="JSON file mapping the names of the captures to their types",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of worker processes",
+    )
+    linestats.add_arguments(parser)
+    args = parser.parse_args()
+
+    try:
+        patterns = PatternSet(args.patterns)
+        convert = make_record_converter(load_schema(args))
+    except (ValueError, re.error) as e:
+        parser.error(str(e))
+    stats = linestats.from_args(args)
+
+    # Correctly die on broken pipe:
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+    if args.jobs > 1:
+        with ProcessPoolExecutor(
+            args.jobs, initializer=_init_worker, initargs=(args,)
+        ) as executor:
+            tasks = ((block,) for block in read_blocks(stdin.buffer.read))
+            for output, counters in map_ordered(
+                executor, _process_block, tasks, 2 * args.jobs
+            ):
+                stdout.write(output)
+                if counters is not None:
+                    stats.merge(counters)
+                    stats.maybe_report()
+    else:
+        for block in read_blocks(stdin.buffer.read1):
+            stdout.write(process_block(block, patterns, convert, stats))
+            if args.adaptive:
+                patterns.reorder()
+            if stats is not None:
+                stats.maybe_report()
+
+    if stats is not None:
+        stats.report(final=True)
+
 
+if __name__ == "__main__":
+    main()
@@ -24,39 +24,121 @@
 
 """
 splitapparmor - Split ASCII Armor (or PEM) files into multiple files
+
+Each block is written into FILENAME.N. With --index, the offset, length and
+kind of each block are listed instead. With --dedup DIR, each distinct block
+is written once into DIR (named by the SHA-256 of its content) and
+DIR/manifest.json maps the input files to their blocks.
+
+The files are processed in parallel.
 """
 
+import argparse
+import hashlib
+import json
+import mmap
+import os
 import re
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+# Markers are at the start of a line (checked separately: searching for
+# the literal prefix is much faster than anchoring with ^):
+RE = re.compile(rb"-----(BEGIN|END) ([A-Z0-8]*)-----\r?$\n?", re.MULTILINE)
 
-RE = re.compile("^-----(BEGIN|END) ([A-Z0-8]*)-----$")
+MANIFEST_NAME = "manifest.json"
 
-def split_file(filename):
-    i = 0
-    lines = []
+def find_blocks(data):
+    """Find the (start, end, kind) of the blocks using a single pass over the data"""
+    start = None
     kind = None
-    with open(filename, "rt") as f:
-        while True:
-            line = f.readline()
-            if line == "":
-                break
-            match = RE.match(line)
-            if len(lines) == 0:
-                if match and match.group(1) == "BEGIN":
-                    kind = match.group(2)
-                    lines.append(line)
-            elif match and match.group(1) == "END" and kind == match.group(2):
-                lines.append(line)
-                with open(filename + "." + str(i), "wt") as out:
-                    out.write("".join(lines))
-                lines.clear()
-                kind = None
-                i = i + 1
-            else:
-                lines.append(line)
-        if len(lines) != 0:
-            raise Exception("File not terminated properly")
-
-filenames = sys.argv[1:]
-for filename in filenames:
-    split_file(filename)
+    for match in RE.finditer(data):
+        if match.start() != 0 and data[match.start() - 1] != 0x0A:
+            continue
+        if start is None:
+            if match.group(1) == b"BEGIN":
+                start = match.start()
+                kind = match.group(2)
+        elif match.group(1) == b"END" and kind == match.group(2):
+            yield start, match.end(), kind.decode()
+            start = None
+            kind = None
+    if start is not None:
+        raise Exception("File not terminated properly")
+
+def write_unique(filename, data):
+    """Write a content-addressed file (unless it already exists)"""
+    if os.path.exists(filename):
+        return
+    tmp = "%s.%i.tmp" % (filename, os.getpid())
+    with open(tmp, "wb") as out:
+        out.write(data)
+    os.replace(tmp, filename)
+
+def split_file(filename, index=False, dedup=None):
+    """Split a file, returns its blocks as (offset, length, kind, hash)"""
+    blocks = []
+    with open(filename, "rb") as f:
+        if f.seek(0, 2) == 0:
+            return blocks
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+                memoryview(data) as view:
+            for i, (start, end, kind) in enumerate(find_blocks(data)):
+                digest = None
+                # Write directly from the mapped file:
+                with view[start:end] as block:
+                    if dedup is not None:
+                        digest = hashlib.sha256(block).hexdigest()
+                        write_unique(os.path.join(dedup, digest), block)
+                    elif not index:
+                        with open(filename + "." + str(i), "wb") as out:
+                            out.write(block)
+                blocks.append((start, end - start, kind, digest))
+    return blocks
+
+def update_manifest(dedup, files):
+    """Update the manifest with the blocks of the given files"""
+    filename = os.path.join(dedup, MANIFEST_NAME)
+    manifest = {}
+    if os.path.exists(filename):
+        with open(filename, "rt") as f:
+            manifest = json.load(f)
+    for name, blocks in files.items():
+        manifest[name] = [
+            {"hash": digest, "kind": kind, "offset": offset, "length": length}
+            for offset, length, kind, digest in blocks
+        ]
+    tmp = filename + ".tmp"
+    with open(tmp, "wt") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, filename)
+
+def main():
+    parser = argparse.ArgumentParser(description="Split ASCII Armor (or PEM) files into multiple files")
+    parser.add_argument("filenames", metavar="FILE", nargs="+")
+    parser.add_argument("--index", action="store_true", default=False,
+                        help="List the blocks (file, offset, length, kind) instead of writing them")
+    parser.add_argument("--dedup", metavar="DIR",
+                        help="Write each distinct block once in DIR (named by its SHA-256) with a manifest")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count(),
+                        help="Number of worker processes")
+    args = parser.parse_args()
+    if args.index and args.dedup is not None:
+        parser.error("--index and --dedup are mutually exclusive")
+    if args.dedup is not None:
+        os.makedirs(args.dedup, exist_ok=True)
+
+    files = {}
+    with ProcessPoolExecutor(args.jobs) as executor:
+        results = executor.map(split_file, args.filenames, repeat(args.index), repeat(args.dedup))
+        for filename, blocks in zip(args.filenames, results):
+            if args.index:
+                for offset, length, kind, digest in blocks:
+                    sys.stdout.write("%s\t%i\t%i\t%s\n" % (filename, offset, length, kind))
+            files[filename] = blocks
+    if args.dedup is not None:
+        update_manifest(args.dedup, files)
+
+if __name__ == "__main__":
+    main()
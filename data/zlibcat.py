@@ -1,11 +1,338 @@
 #!/usr/bin/python3
 
-"""Uncompress raw zlib data."""
+"""Uncompress raw zlib data.
 
-from sys import argv, stdout
-from zlib import decompress
+zlib, gzip and raw deflate streams are detected automatically. Concatenated
+streams are supported. Data is decompressed incrementally (in bounded memory)
+and several files can be decompressed concurrently (--jobs) while still
+being written in order.
 
-for filename in argv[1:]:
-    with open(filename, "rb") as f:
-        data = decompress(f.read())
-    stdout.buffer.write(data)
+With --scan, find the zlib and gzip streams embedded in binary files
+(memory dumps, firmware images, etc.): list them with their offsets
+and optionally extract them (--extract).
+"""
+
+import mmap
+import os
+import re
+import signal
+import sys
+import zlib
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from queue import Full, Queue
+from threading import Event
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+READ_SIZE = 256 * 1024
+OUTPUT_SIZE = 1024 * 1024
+QUEUE_SIZE = 8
+
+FORMAT_WBITS = {"zlib": 15, "gzip": 16 + 15, "raw": -15}
+
+
+def is_zlib_header(data: bytes) -> bool:
+    return (
+        len(data) >= 2
+        and data[0] & 0x0F == 8
+        and data[0] >> 4 <= 7
+        and (data[0] << 8 | data[1]) % 31 == 0
+    )
+
+
+def detect_format(data: bytes) -> str:
+    if data[:2] == b"\x1f\x8b":
+        return "gzip"
+    if is_zlib_header(data):
+        return "zlib"
+    return "raw"
+
+
+def decompress_stream(
+    input: BinaryIO, format: str = "auto", filename: str = "-"
+) -> Iterator[bytes]:
+    """Decompress a sequence of concatenated streams
+
+    Trailing null bytes (padding) are ignored. In auto mode, the data
+    following a stream is only decompressed if it starts with a zlib or gzip
+    header: other trailing data is ignored (with a warning).
+    """
+    data = b""
+    eof = False
+    first = True
+    while True:
+        # Find the start of the next stream:
+        while not eof and len(data) < 2:
+            chunk = input.read(READ_SIZE)
+            eof = not chunk
+            data += chunk
+        if not data or (not first and not data.strip(b"\0")):
+            if eof:
+                return
+            data = b""
+            continue
+        stream_format = detect_format(data) if format == "auto" else format
+        if not first and format == "auto" and stream_format == "raw":
+            sys.stderr.write("zlibcat: %s: ignoring trailing data\n" % filename)
+            return
+        first = False
+        decompressor = zlib.decompressobj(FORMAT_WBITS[stream_format])
+        while not decompressor.eof:
+            if not data:
+                if eof:
+                    raise zlib.error("Truncated %s stream" % stream_format)
+                data = input.read(READ_SIZE)
+                eof = not data
+                continue
+            # Bound the size of the output chunks:
+            output = decompressor.decompress(data, OUTPUT_SIZE)
+            data = decompressor.unconsumed_tail
+            if output:
+                yield output
+        data = decompressor.unused_data
+
+
+def open_input(filename: str) -> BinaryIO:
+    if filename == "-":
+        return open(sys.stdin.fileno(), "rb", closefd=False)
+    return open(filename, "rb")
+
+
+def _put(queue: Queue, item, cancelled: Event) -> bool:
+    while not cancelled.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _produce(filename: str, format: str, queue: Queue, cancelled: Event) -> None:
+    """Decompress a file into a queue (terminated by None or an exception)"""
+    try:
+        with open_input(filename) as input:
+            for chunk in decompress_stream(input, format, filename):
+                if not _put(queue, chunk, cancelled):
+                    return
+        _put(queue, None, cancelled)
+    except Exception as e:
+        _put(queue, e, cancelled)
+
+
+def _header_pattern() -> re.Pattern:
+    """Regex of the possible zlib (without preset dictionary) and gzip headers"""
+    alternatives = [re.escape(b"\x1f\x8b\x08")]
+    for cinfo in range(8):
+        cmf = cinfo << 4 | 8
+        flags = bytes(
+            flg for flg in range(256) if (cmf << 8 | flg) % 31 == 0 and not flg & 0x20
+        )
+        alternatives.append(re.escape(bytes([cmf])) + b"[" + re.escape(flags) + b"]")
+    return re.compile(b"|".join(alternatives))
+
+
+HEADER_PATTERN = _header_pattern()
+SEGMENT_SIZE = 64 * 1024 * 1024
+TRIAL_SIZE = 4096
+
+# (offset, format, compressed size, size, status)
+Stream = Tuple[int, str, int, int, str]
+
+
+def decompress_at(
+    data: mmap.mmap, offset: int, format: str, output: Optional[BinaryIO] = None
+) -> Optional[Tuple[int, int, str]]:
+    """Decompress a candidate stream
+
+    Returns (compressed size, size, status) where the status is "complete",
+    "truncated" (end of the data reached) or "corrupt". Returns None if the
+    decompression fails in the first TRIAL_SIZE bytes of input.
+    """
+    decompressor = zlib.decompressobj(FORMAT_WBITS[format])
+    pos = offset
+    size = 0
+    read_size = TRIAL_SIZE
+    try:
+        while not decompressor.eof and pos < len(data):
+            chunk = data[pos : pos + read_size]
+            pos += len(chunk)
+            read_size = READ_SIZE
+            while chunk and not decompressor.eof:
+                # Bound the size of the output chunks:
+                out = decompressor.decompress(chunk, OUTPUT_SIZE)
+                chunk = decompressor.unconsumed_tail
+                size += len(out)
+                if output is not None:
+                    output.write(out)
+    except zlib.error:
+        if pos - offset <= TRIAL_SIZE:
+            return None
+        return pos - offset, size, "corrupt"
+    if decompressor.eof:
+        return pos - offset - len(decompressor.unused_data), size, "complete"
+    return pos - offset, size, "truncated"
+
+
+def _scan_segment(
+    filename: str, start: int, end: int, partial: bool, min_size: int
+) -> List[Stream]:
+    """Find the streams starting in a segment of a file"""
+    res = []
+    with open(filename, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as data:
+        pos = start
+        while True:
+            match = HEADER_PATTERN.search(data, pos, min(end + 2, len(data)))
+            if match is None or match.start() >= end:
+                break
+            offset = match.start()
+            format = "gzip" if data[offset] == 0x1F else "zlib"
+            result = decompress_at(data, offset, format)
+            if result is None or result[1] < min_size:
+                pos = offset + 1
+                continue
+            csize, size, status = result
+            if status != "complete" and not partial:
+                pos = offset + 1
+                continue
+            res.append((offset, format, csize, size, status))
+            # Skip the content of the stream:
+            pos = offset + max(csize, 1)
+    return res
+
+
+def scan_file(
+    filename: str, executor: ProcessPoolExecutor, partial: bool, min_size: int
+) -> List[Stream]:
+    """Find the streams in a file (segments are scanned in parallel)"""
+    size = os.path.getsize(filename)
+    futures = [
+        executor.submit(
+            _scan_segment, filename, start, start + SEGMENT_SIZE, partial, min_size
+        )
+        for start in range(0, size, SEGMENT_SIZE)
+    ]
+    res = []
+    end = 0
+    for future in futures:
+        for stream in future.result():
+            # Ignore the streams found inside another stream:
+            if stream[0] < end:
+                continue
+            res.append(stream)
+            end = stream[0] + stream[2]
+    return res
+
+
+def scan(args) -> int:
+    status = 0
+    with ProcessPoolExecutor(args.jobs) as executor:
+        for filename in args.files:
+            try:
+                streams = scan_file(filename, executor, args.partial, args.min_size)
+            except (OSError, ValueError) as e:
+                sys.stderr.write("zlibcat: %s: %s\n" % (filename, e))
+                status = 1
+                continue
+            if streams and args.extract is not None:
+                os.makedirs(args.extract, exist_ok=True)
+                with open(filename, "rb") as f, mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ
+                ) as data:
+                    for offset, format, csize, size, stream_status in streams:
+                        name = "%s.%x.%s" % (os.path.basename(filename), offset, format)
+                        with open(os.path.join(args.extract, name), "wb") as output:
+                            decompress_at(data, offset, format, output)
+            for offset, format, csize, size, stream_status in streams:
+                sys.stdout.write(
+                    "%s\t%i\t0x%x\t%s\t%i\t%i\t%s\n"
+                    % (filename, offset, offset, format, csize, size, stream_status)
+                )
+    return status
+
+
+def main():
+    parser = ArgumentParser(description="Uncompress zlib, gzip or raw deflate data")
+    parser.add_argument("files", metavar="FILE", nargs="*", default=["-"])
+    parser.add_argument(
+        "--format",
+        choices=["auto"] + list(FORMAT_WBITS),
+        default="auto",
+        help="Format of the compressed streams",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of files decompressed concurrently"
+        + " (with --scan, number of processes)",
+    )
+    parser.add_argument(
+        "--scan",
+        action="store_true",
+        default=False,
+        help="Find the zlib and gzip streams embedded in the files"
+        + " (file, offset, hex offset, format, compressed size, size, status)",
+    )
+    parser.add_argument(
+        "--extract",
+        metavar="DIR",
+        help="With --scan, decompress the streams found into this directory",
+    )
+    parser.add_argument(
+        "--partial",
+        action="store_true",
+        default=False,
+        help="With --scan, report truncated and corrupt streams as well",
+    )
+    parser.add_argument(
+        "--min-size",
+        type=int,
+        default=1,
+        help="With --scan, minimum decompressed size of the reported streams",
+    )
+    args = parser.parse_args()
+
+    # Correctly die on broken pipe:
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+    if args.scan:
+        if "-" in args.files:
+            parser.error("--scan cannot be used with standard input")
+        sys.exit(scan(args))
+
+    output = sys.stdout.buffer
+    status = 0
+    # Stop the producers blocked on a full queue (eg. on interruption):
+    cancelled = Event()
+    with ThreadPoolExecutor(args.jobs) as executor:
+        try:
+            # The files are decompressed in order: the bounded queues
+            # limit the memory used for the files not yet written.
+            queues = []
+            for filename in args.files:
+                queue = Queue(QUEUE_SIZE)
+                executor.submit(_produce, filename, args.format, queue, cancelled)
+                queues.append((filename, queue))
+            for filename, queue in queues:
+                while True:
+                    chunk = queue.get()
+                    if chunk is None:
+                        break
+                    if isinstance(chunk, Exception):
+                        output.flush()
+                        sys.stderr.write("zlibcat: %s: %s\n" % (filename, chunk))
+                        status = 1
+                        break
+                    output.write(chunk)
+        finally:
+            cancelled.set()
+    output.flush()
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()